@@ -0,0 +1,112 @@
+"""
+Synthetic dataset and the timed operations
+
+Every case is a function (context, iteration) run once per iteration, the iteration picks the user
+so that consecutive runs don't hit the same rows.
+"""
+import logging
+
+from database import storage
+from modules.main import common, inline, view
+from storage import EntryType
+
+from fakes import FakeBot, command_update, inline_query_update
+
+
+class Context:
+    def __init__(self, users, packs, entries, sets, sticker_set_latency, send_latency):
+        self.storage = storage
+        self.users = users
+        self.packs = packs
+        self.entries = entries
+        self.sets = sets
+        self.bot = FakeBot(sticker_set_latency, send_latency)
+        self.user_data = {}
+
+    def user(self, iteration):
+        return iteration % self.users + 1
+
+
+def seed(context, shared_sets=50):
+    """Every user gets `packs` packs with `entries` stickers and `sets` sticker sets each"""
+    for user_id in range(1, context.users + 1):
+        with storage.session_scope() as session:
+            for pack in range(context.packs):
+                pack_entries = [(EntryType.STICKER.value, 'u%dp%de%d' % (user_id, pack, i))
+                                for i in range(context.entries)]
+                pack_entries += [(EntryType.PACK.value, 'set%d' % ((user_id + pack + i) % shared_sets))
+                                 for i in range(context.sets)]
+                storage.import_pack(session, user_id, 'pack%d' % pack, pack_entries)
+    logging.info("Seeded %d users with %d packs each", context.users, context.packs)
+
+
+def clear_caches():
+    common.sticker_set_cache.clear()
+    common.sticker_set_sizes.clear()
+    inline.inline_result_cache.clear()
+
+
+def get_entries(context, i):
+    with storage.session_scope() as session:
+        storage.get_entries(session, context.user(i), 'pack0', False)
+
+
+def add_entry(context, i):
+    # Adds the entry on even iterations of a user and removes it on the odd ones
+    with storage.session_scope() as session:
+        storage.add_entry(session, context.user(i), 'pack0', EntryType.STICKER, 'toggled', only_remove=False)
+
+
+def import_pack(context, i):
+    pack_entries = [(EntryType.STICKER.value, 'imported%d' % n) for n in range(300)]
+    with storage.session_scope() as session:
+        storage.import_pack(session, context.user(i), 'imported%d' % i, pack_entries)
+
+
+def count_total_entries(context, i):
+    with storage.session_scope() as session:
+        storage.count_total_entries(session, context.user(i))
+
+
+def search_packs(context, i):
+    with storage.session_scope() as session:
+        storage.search_packs(session, context.user(i), 'ack1', inline.INLINE_MAX_PACKS)
+
+
+def get_pack_entries_cold(context, i):
+    clear_caches()
+    common.get_pack_entries(context.bot, context.user(i), ['pack0'], 0, view.MAX_VIEW_RESULTS)
+
+
+def get_pack_entries_warm(context, i):
+    common.get_pack_entries(context.bot, context.user(i), ['pack0'], view.MAX_VIEW_RESULTS, view.MAX_VIEW_RESULTS)
+
+
+def inline_query_cold(context, i):
+    clear_caches()
+    inline.on_inline_query(context.bot, inline_query_update(context.bot, context.user(i), 'pack'))
+
+
+def inline_query_warm(context, i):
+    inline.on_inline_query(context.bot, inline_query_update(context.bot, context.user(i), 'pack', offset='1'))
+
+
+def view_pack(context, i):
+    user_id = context.user(i)
+    user_data = context.user_data.setdefault(user_id, {})
+    view.view_pack(context.bot, command_update(user_id, '/view pack0'), 'pack0|%d' % (i % 2), user_data)
+
+
+# (name, case), the warm-up runs every case once per user before timing it
+CASES = [
+    ('storage.get_entries', get_entries),
+    ('storage.add_entry', add_entry),
+    ('storage.import_pack', import_pack),
+    ('storage.count_total_entries', count_total_entries),
+    ('storage.search_packs', search_packs),
+    ('common.get_pack_entries.cold', get_pack_entries_cold),
+    ('common.get_pack_entries.warm', get_pack_entries_warm),
+    ('inline.on_inline_query.cold', inline_query_cold),
+    ('inline.on_inline_query.warm', inline_query_warm),
+    ('view.view_pack', view_pack),
+]
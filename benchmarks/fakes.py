@@ -0,0 +1,95 @@
+"""
+Stand-ins for the Telegram objects used by the handlers, no network involved
+"""
+import itertools
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+from telegram.error import BadRequest
+
+STICKERS_PER_SET = 30
+# Sticker sets with this prefix behave like deleted ones
+MISSING_SET_PREFIX = 'missing'
+
+
+class FakeBot:
+    """Bot whose API calls only sleep for the configured latency and count themselves"""
+
+    def __init__(self, sticker_set_latency=0.0, send_latency=0.0):
+        self.sticker_set_latency = sticker_set_latency
+        self.send_latency = send_latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+
+    def _call(self, method, latency):
+        with self._lock:
+            self.calls[method] += 1
+        if latency:
+            time.sleep(latency)
+
+    def _sent_message(self, method):
+        self._call(method, self.send_latency)
+        with self._lock:
+            return SimpleNamespace(message_id=next(self._message_ids), text=None)
+
+    def get_sticker_set(self, name):
+        self._call('get_sticker_set', self.sticker_set_latency)
+        if name.startswith(MISSING_SET_PREFIX):
+            raise BadRequest("Stickerset_invalid")
+        stickers = [SimpleNamespace(file_id='%s_%d' % (name, i)) for i in range(STICKERS_PER_SET)]
+        return SimpleNamespace(name=name, stickers=stickers)
+
+    def send_sticker(self, chat_id, sticker, **kwargs):
+        return self._sent_message('send_sticker')
+
+    def send_document(self, chat_id, document, **kwargs):
+        return self._sent_message('send_document')
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._sent_message('send_message')
+
+    def delete_message(self, chat_id, message_id, **kwargs):
+        self._call('delete_message', self.send_latency)
+        return True
+
+    def answer_inline_query(self, inline_query_id, results, **kwargs):
+        self._call('answer_inline_query', self.send_latency)
+        return True
+
+    def submit(self, method_name, *args, **kwargs):
+        """Like ScheduledBot.submit, the call runs right away"""
+        future = Future()
+        try:
+            future.set_result(getattr(self, method_name)(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+def inline_query_update(bot, user_id, query, offset=''):
+    def answer(results, **kwargs):
+        return bot.answer_inline_query('0', results, **kwargs)
+
+    user = SimpleNamespace(id=user_id)
+    return SimpleNamespace(
+        inline_query=SimpleNamespace(id='0', query=query, offset=offset, answer=answer),
+        effective_user=user,
+        effective_chat=SimpleNamespace(id=user_id),
+        callback_query=None,
+        message=None,
+    )
+
+
+def command_update(user_id, text):
+    user = SimpleNamespace(id=user_id)
+    return SimpleNamespace(
+        inline_query=None,
+        effective_user=user,
+        effective_chat=SimpleNamespace(id=user_id),
+        callback_query=None,
+        message=SimpleNamespace(text=text, chat_id=user_id),
+    )
@@ -0,0 +1,139 @@
+"""
+Offline benchmarks of the storage and of the handlers hot paths
+
+Seeds a throwaway SQLite database with synthetic users, then times every case of cases.py with a fake
+Bot (no network) and writes the results as JSON. Passing a previous result as --baseline prints how
+much every case changed and exits with 1 if one of them got slower than --max-regression.
+
+Usage: python3 benchmarks/run.py [--output results.json] [--baseline baseline.json] [--only storage]
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def configure_environment(db_path):
+    """The bot modules read their configuration at import time"""
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + db_path)
+    os.environ.setdefault('WEBHOOK', 'False')
+    os.environ.setdefault('TOKEN', '0:benchmark')
+    os.environ.setdefault('ENTRY_LIMIT', '-1')
+    os.environ.setdefault('LOG_LEVEL', str(logging.WARNING))
+    sys.path.insert(0, str(ROOT / 'ourdb'))
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def run_case(context, case, repeat, collect_queries):
+    # The warm-up visits every user once, then the same users are cycled while timing
+    for i in range(context.users):
+        case(context, i)
+
+    timings = []
+    with collect_queries() as stats:
+        for i in range(context.users, context.users + repeat):
+            start = time.perf_counter()
+            case(context, i)
+            timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    return {
+        'runs': repeat,
+        'min_ms': timings[0],
+        'median_ms': statistics.median(timings),
+        'mean_ms': statistics.mean(timings),
+        'p95_ms': percentile(timings, 0.95),
+        'max_ms': timings[-1],
+        'queries': stats.queries / repeat,
+    }
+
+
+def compare(results, baseline, max_regression):
+    """Prints the change of the median of every case, returns the names of the regressed ones"""
+    regressed = []
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            print("%-32s %10.3f ms  (new)" % (name, result['median_ms']))
+            continue
+        change = result['median_ms'] / base['median_ms'] - 1 if base['median_ms'] else 0
+        flag = ''
+        if change > max_regression:
+            regressed.append(name)
+            flag = '  REGRESSION'
+        print("%-32s %10.3f ms  %+7.1f%%%s" % (name, result['median_ms'], change * 100, flag))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the OurDB storage and handlers")
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--packs', type=int, default=20, help="packs per user")
+    parser.add_argument('--entries', type=int, default=100, help="stickers per pack")
+    parser.add_argument('--sets', type=int, default=3, help="sticker sets per pack")
+    parser.add_argument('--repeat', type=int, default=50, help="timed runs of every case")
+    parser.add_argument('--sticker-set-latency', type=float, default=0.05,
+                        help="seconds taken by every get_sticker_set call")
+    parser.add_argument('--send-latency', type=float, default=0.0, help="seconds taken by every other API call")
+    parser.add_argument('--only', help="run only the cases whose name contains this")
+    parser.add_argument('--output', help="where to write the JSON results (default: stdout)")
+    parser.add_argument('--baseline', help="JSON results of a previous run to compare with")
+    parser.add_argument('--max-regression', type=float, default=0.1,
+                        help="slowdown of the median tolerated by --baseline (0.1 = 10%%)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        configure_environment(os.path.join(tmp, 'benchmark.db'))
+        import cases
+        from metrics import collect_queries
+
+        context = cases.Context(args.users, args.packs, args.entries, args.sets,
+                                args.sticker_set_latency, args.send_latency)
+        cases.seed(context)
+
+        results = {}
+        for name, case in cases.CASES:
+            if args.only and args.only not in name:
+                continue
+            results[name] = run_case(context, case, args.repeat, collect_queries)
+            print("%-32s %10.3f ms %8.1f queries" % (name, results[name]['median_ms'], results[name]['queries']),
+                  file=sys.stderr)
+
+        context.storage.engine.dispose()
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressed = compare(results, json.load(f), args.max_regression)
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
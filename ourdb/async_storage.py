@@ -0,0 +1,136 @@
+"""
+Asyncio version of DbStorage, built on the SQLAlchemy async engine
+
+It needs an async database driver: asyncpg for PostgreSQL or aiosqlite for SQLite
+(DATABASE_URL is converted automatically, ex. sqlite:///test.db -> sqlite+aiosqlite:///test.db).
+"""
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from storage import DB_URL, IMPORT_BATCH_SIZE, EXPORT_BATCH_SIZE, StorageQueries, engine_args
+
+ASYNC_DRIVERS = {
+    'postgres': 'postgresql+asyncpg',
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def to_async_url(db_url):
+    scheme, sep, rest = db_url.partition('://')
+    return ASYNC_DRIVERS.get(scheme, scheme) + sep + rest
+
+
+class _SessionScope:
+    """The async context manager returned by AsyncDbStorage.session_scope (asynccontextmanager needs Python 3.7)"""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = self.storage.Session()
+        return self.session
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        session = self.session
+        try:
+            if exc_type is not None:
+                await session.rollback()
+                return False
+            try:
+                await session.commit()
+            except:
+                await session.rollback()
+                raise
+            for user_id in session.info.pop('changed_users', ()):
+                for listener in self.storage.change_listeners:
+                    listener(user_id)
+            return False
+        finally:
+            await session.close()
+
+
+class AsyncDbStorage:
+    """
+    Same API as DbStorage but every method is a coroutine, ex:
+
+        async with storage.session_scope() as session:
+            packs = await storage.get_packs(session, user_id)
+    """
+
+    def __init__(self, db_url=None):
+        db_url = db_url or DB_URL
+        self.queries = StorageQueries()
+        self.engine = create_async_engine(to_async_url(db_url), **engine_args(db_url))
+        self.Session = sessionmaker(bind=self.engine, class_=AsyncSession, expire_on_commit=False)
+        self.change_listeners = []
+
+    async def init(self):
+        async with self.session_scope() as session:
+            await session.run_sync(self.queries.init_schema)
+
+    def add_change_listener(self, listener):
+        """Registers a function called with the user id whenever a transaction modifying their entries commits"""
+        self.change_listeners.append(listener)
+
+    def session_scope(self):
+        """Provide a transactional scope around a series of operations."""
+        return _SessionScope(self)
+
+    async def close(self):
+        await self.engine.dispose()
+
+    async def get_meta(self, session, key):
+        return await session.run_sync(self.queries.get_meta, key)
+
+    async def set_meta(self, session, key, value):
+        return await session.run_sync(self.queries.set_meta, key, value)
+
+    async def get_packs(self, session, user_id):
+        return await session.run_sync(self.queries.get_packs, user_id)
+
+    async def has_pack(self, session, user_id, name):
+        return await session.run_sync(self.queries.has_pack, user_id, name)
+
+    async def remove_pack(self, session, user_id, name):
+        return await session.run_sync(self.queries.remove_pack, user_id, name)
+
+    async def get_entries(self, session, user_id, pack_name, similar):
+        return await session.run_sync(self.queries.get_entries, user_id, pack_name, similar)
+
+    async def search_packs(self, session, user_id, query, limit):
+        return await session.run_sync(self.queries.search_packs, user_id, query, limit)
+
+    async def iter_all_entries(self, session, user_id, batch_size=EXPORT_BATCH_SIZE):
+        """Async generator, use with: async for pack_name, entry_type, entry_data in ..."""
+        result = await session.stream(self.queries.all_entries_query(user_id, batch_size))
+        async for pack_name, entry_type, entry_data in result:
+            yield pack_name, entry_type, entry_data
+
+    async def get_entry_layout(self, session, user_id, pack_names):
+        return await session.run_sync(self.queries.get_entry_layout, user_id, pack_names)
+
+    async def get_plain_entries(self, session, user_id, pack_name, offset, limit):
+        return await session.run_sync(self.queries.get_plain_entries, user_id, pack_name, offset, limit)
+
+    async def get_existing_entries(self, session, user_id, pack_names):
+        return await session.run_sync(self.queries.get_existing_entries, user_id, pack_names)
+
+    async def has_entry(self, session, user_id, pack_name, entry_type, entry_data):
+        return await session.run_sync(self.queries.has_entry, user_id, pack_name, entry_type, entry_data)
+
+    async def add_entry(self, session, user_id, pack_name, entry_type, entry_data, only_remove=True):
+        return await session.run_sync(self.queries.add_entry, user_id, pack_name, entry_type, entry_data, only_remove)
+
+    async def remove_every_pack_mention(self, session, user_id, stickerpack_name):
+        return await session.run_sync(self.queries.remove_every_pack_mention, user_id, stickerpack_name)
+
+    async def import_pack(self, session, user_id, pack_name, pack_entries, batch_size=IMPORT_BATCH_SIZE):
+        return await session.run_sync(self.queries.import_pack, user_id, pack_name, pack_entries, batch_size)
+
+    async def count_total_entries(self, session, user_id):
+        return await session.run_sync(self.queries.count_total_entries, user_id)
+
+    async def reconcile_entry_counts(self, session):
+        return await session.run_sync(self.queries.reconcile_entry_counts)
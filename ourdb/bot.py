@@ -1,16 +1,39 @@
+import atexit
 import logging
 import os
+import sys
+
+if __name__ == '__main__':
+    # Anything importing bot gets this module instead of running it a second time
+    sys.modules.setdefault('bot', sys.modules[__name__])
 
 LOG_LEVEL = int(os.environ.get('LOG_LEVEL', default=logging.INFO))
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=LOG_LEVEL)
 
+from botutils import StepTimer
+
+startup_timer = StepTimer()
+
+import hashlib
+
 import telegram
 from telegram.ext import *
 
-import modules
+import metrics
+from cluster import WebhookCluster
+from outbound import OutboundScheduler, ScheduledBot, TimedRequest, OUTBOUND_GLOBAL_RATE, OUTBOUND_WORKERS
+from persistence import DbPersistence, PERSISTENCE_FLUSH_INTERVAL
 from storage import *
 
+startup_timer.step('imports')
+
+from database import storage
+
+startup_timer.step('storage')
+
+import modules
+
 
 WEBHOOK = os.environ['WEBHOOK'] == 'True'
 
@@ -20,18 +43,36 @@ if WEBHOOK:
 
 TOKEN = os.environ['TOKEN']
 
-storage = DbStorage()
-storage.init()
+# Processes that handle the webhook updates, every user is always served by the same one
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', default=1))
+PROCESSES = WEBHOOK_WORKERS if WEBHOOK else 1
+
+# Seconds between two checks of the per-user entry counters
+RECONCILE_INTERVAL = int(os.environ.get('RECONCILE_INTERVAL', default=60 * 60 * 24))
+
+startup_timer.step('modules')
 
 
 def error_callback(bot, update, error):
     logging.exception("Error %s", error)
 
 
-def main():
-    updater = Updater(TOKEN)
+def reconcile_entry_counts(bot, job):
+    with storage.session_scope() as session:
+        storage.reconcile_entry_counts(session)
+
+
+def create_updater(run_jobs=True):
+    """Creates the updater with every handler, run_jobs schedules the jobs that only one process must run"""
+    # Leave some connections for the handler threads and the calls that are not scheduled (ex. get_sticker_set)
+    request = TimedRequest(con_pool_size=OUTBOUND_WORKERS + 16)
+    # Every process sends its own messages, they share the global rate limit of the bot
+    scheduler = OutboundScheduler(global_rate=OUTBOUND_GLOBAL_RATE / PROCESSES)
+    updater = Updater(bot=ScheduledBot(TOKEN, scheduler, request=request))
 
     dp = updater.dispatcher
+    # Every storage call made while handling an update shares the same session
+    dp.process_update = storage.bind_unit_of_work(dp.process_update)
 
     handlers = modules.__handlers__
 
@@ -39,6 +80,52 @@ def main():
         dp.add_handler(handler)
 
     dp.add_error_handler(error_callback)
+    metrics.instrument_handlers(handlers)
+
+    # Every process writes its own conversation data
+    persistence = DbPersistence(storage)
+    persistence.attach(dp, modules.__conversations__)
+    # The cluster workers flush on SIGTERM instead (see cluster.run_worker)
+    atexit.register(persistence.flush)
+    updater.persistence = persistence
+    dp.process_update = metrics.track_updates(dp.process_update)
+    updater.job_queue.run_repeating(persistence.flush_job, interval=PERSISTENCE_FLUSH_INTERVAL)
+    if run_jobs:
+        updater.job_queue.run_repeating(reconcile_entry_counts, interval=RECONCILE_INTERVAL, first=60)
+
+    return updater
+
+
+def ensure_webhook(url):
+    """Sets the webhook only if it changed since the last time, saving a slow API call on every start"""
+    # Only a hash is stored, the url contains the token
+    url_hash = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    with storage.session_scope() as session:
+        if storage.get_meta(session, 'webhook_url_hash') == url_hash:
+            logging.info("Webhook already set")
+            return
+    telegram.Bot(TOKEN).set_webhook(url)
+    with storage.session_scope() as session:
+        storage.set_meta(session, 'webhook_url_hash', url_hash)
+
+
+def init_worker(index):
+    # Connections opened by the parent process can't be shared with the forked workers
+    storage.engine.dispose(close=False)
+    if metrics.METRICS_PORT:
+        metrics.start_metrics_server(metrics.METRICS_PORT + index)
+
+
+def main():
+    if WEBHOOK and WEBHOOK_WORKERS > 1:
+        logging.info("Startup: %s", startup_timer.report())
+        WebhookCluster(TOKEN, WEBHOOK_WORKERS, create_updater, init_worker).serve(URL, PORT, ensure_webhook)
+        return
+
+    updater = create_updater()
+    if metrics.METRICS_PORT:
+        metrics.start_metrics_server(metrics.METRICS_PORT)
+    startup_timer.step('handlers')
 
     if WEBHOOK:
         logging.info("Starting webhook at %s port %d", URL, PORT)
@@ -48,10 +135,15 @@ def main():
             url_path=TOKEN
         )
 
-        updater.bot.set_webhook(URL + TOKEN)
+        ensure_webhook(URL + TOKEN)
     else:
         logging.info("Starting polling")
+        # Polling deletes the webhook
+        with storage.session_scope() as session:
+            storage.set_meta(session, 'webhook_url_hash', None)
         updater.start_polling()
+    startup_timer.step('start')
+    logging.info("Startup: %s", startup_timer.report())
 
     updater.idle()
 
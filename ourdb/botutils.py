@@ -1,3 +1,5 @@
+import threading
+import time
 from functools import wraps
 
 
@@ -55,6 +57,25 @@ def lookahead(iterable):
     yield last, False
 
 
+def when_all_done(futures, callback):
+    """Calls callback(futures) once every future is done, in the thread that completes the last one"""
+    if not futures:
+        callback(futures)
+        return
+    lock = threading.Lock()
+    remaining = [len(futures)]
+
+    def on_done(future):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            callback(futures)
+
+    for future in futures:
+        future.add_done_callback(on_done)
+
+
 def edit_or_send(bot, update, text, reply_markup=None):
     if update.callback_query and update.callback_query.message.text:
         update.callback_query.message.edit_text(text, reply_markup=reply_markup)
@@ -67,3 +88,20 @@ VALID_DEEPLINK_CHARS = str.maketrans('', '', 'abcdefghijklmnopqrstuvwxyzABCDEFGH
 
 def is_valid_deeplink(s):
     return not str(s).translate(VALID_DEEPLINK_CHARS)
+
+
+class StepTimer:
+    """Measures a sequence of steps, ex. the startup phases"""
+
+    def __init__(self):
+        self.start = self.last = time.perf_counter()
+        self.steps = []
+
+    def step(self, name):
+        now = time.perf_counter()
+        self.steps.append((name, now - self.last))
+        self.last = now
+
+    def report(self):
+        steps = ', '.join('%s %.3fs' % (name, elapsed) for name, elapsed in self.steps)
+        return '%s (total %.3fs)' % (steps, self.last - self.start)
@@ -0,0 +1,85 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TtlLruCache:
+    """
+    Thread-safe LRU cache whose entries expire after ``ttl`` seconds.
+
+    Every entry has a size (computed by ``sizeof``, 1 by default) and the cache evicts
+    the least recently used entries until the total size is within ``max_size``.
+    """
+
+    def __init__(self, max_size, ttl, sizeof=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: 1)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._data = OrderedDict()  # key -> (expire_time, size, value)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            expire_time, size, value = item
+            if expire_time < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            if size > self.max_size:
+                # It would evict everything else and still not fit
+                return
+            self._data[key] = (time.monotonic() + self.ttl, size, value)
+            self._size += size
+            while self._size > self.max_size:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+
+    def _remove(self, key):
+        _, size, _ = self._data.pop(key)
+        self._size -= size
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def size(self):
+        return self._size
+
+    def stats(self):
+        return {
+            'entries': len(self._data),
+            'size': self._size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -1,7 +1,14 @@
-from telegram import Update, CallbackQuery
+from telegram import Update
 from telegram.ext.handler import Handler
 
 
+def callback_data(update):
+    """Returns the data of a callback query update, None for the other updates"""
+    if isinstance(update, Update) and update.callback_query:
+        return update.callback_query.data or None
+    return None
+
+
 class CallbackCommandHandler(Handler):
     """
         Handler class to handle Telegram callback queries. Optionally based on a regex.
@@ -59,14 +66,6 @@ class CallbackCommandHandler(Handler):
         self.pass_data = pass_data
         self.auto_answer_query = auto_answer_query
 
-        self.next_data = None
-
-    def check_data(self, data):
-        if data[0] == self.cmd_char:
-            self.next_data = data[1:]
-            return True
-        return False
-
     def check_update(self, update):
         """
         Determines whether an update should be passed to this handlers :attr:`callback`.
@@ -77,14 +76,8 @@ class CallbackCommandHandler(Handler):
         Returns:
             :obj:`bool`
         """
-        if not (isinstance(update, Update) and update.callback_query):
-            return
-
-        data = update.callback_query.data
-
-        if not data:
-            return False
-        return self.check_data(data)
+        data = callback_data(update)
+        return data is not None and data.startswith(self.cmd_char)
 
     def handle_update(self, update, dispatcher):
         """
@@ -102,8 +95,53 @@ class CallbackCommandHandler(Handler):
         args = [dispatcher.bot, update]
 
         if self.pass_data:
-            args.append(self.next_data)
+            # Parsed again from the update, the handler is shared by every thread
+            args.append(update.callback_query.data[len(self.cmd_char):])
 
         res = self.callback(*args, **kwargs)
 
         return res
+
+
+class CallbackRouter(Handler):
+    """
+    Sends every callback query to the CallbackCommandHandler of its first char, with a single lookup
+    instead of checking every handler in turn
+
+    Args:
+        handlers (:obj:`list`): The :class:`CallbackCommandHandler` to route to, each with a different
+            single-char :attr:`cmd_char`
+    """
+
+    def __init__(self, handlers):
+        super().__init__(None)
+
+        self.routes = {}
+        for handler in handlers:
+            if len(handler.cmd_char) != 1:
+                raise ValueError("Cannot route the cmd_char %r, it must be a single char" % handler.cmd_char)
+            if handler.cmd_char in self.routes:
+                raise ValueError("Two handlers for the cmd_char %r" % handler.cmd_char)
+            self.routes[handler.cmd_char] = handler
+
+    def check_update(self, update):
+        data = callback_data(update)
+        return data is not None and data[0] in self.routes
+
+    def handle_update(self, update, dispatcher):
+        return self.routes[update.callback_query.data[0]].handle_update(update, dispatcher)
+
+
+def route_callbacks(handlers):
+    """Replaces the CallbackCommandHandlers of a handler list with a CallbackRouter, in the place of the first one"""
+    callbacks = [handler for handler in handlers if isinstance(handler, CallbackCommandHandler)]
+    if len(callbacks) < 2:
+        return list(handlers)
+
+    routed = []
+    for handler in handlers:
+        if handler is callbacks[0]:
+            routed.append(CallbackRouter(callbacks))
+        elif not isinstance(handler, CallbackCommandHandler):
+            routed.append(handler)
+    return routed
@@ -0,0 +1,175 @@
+"""
+Multi-process webhook serving
+
+The main process only receives the webhook requests and forwards every update to one of N worker
+processes chosen by user id, so the conversation state of a user always lives in the same worker.
+Each worker runs its own dispatcher and job queue, the jobs shared by every worker (see
+create_updater's run_jobs) are scheduled only on the first one.
+A worker that dies is restarted right away and gets the updates still waiting in its pipe, the ones
+it was handling are lost.
+"""
+import json
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from telegram import Update
+
+# Seconds given to the workers to save their data when stopping
+WORKER_STOP_TIMEOUT = int(os.environ.get('WORKER_STOP_TIMEOUT', default=10))
+
+# Update fields that carry the user (or at least the chat) that originated it
+UPDATE_FIELDS = (
+    'message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+    'shipping_query', 'pre_checkout_query', 'channel_post', 'edited_channel_post',
+)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """http.server.ThreadingHTTPServer, missing before Python 3.7"""
+    daemon_threads = True
+
+
+def update_user_id(data):
+    """Returns the id of the user (or chat) that sent the raw update, None if there is none"""
+    for field in UPDATE_FIELDS:
+        content = data.get(field)
+        if content is None:
+            continue
+        if 'from' in content:
+            return content['from']['id']
+        if 'chat' in content:
+            return content['chat']['id']
+    return None
+
+
+def worker_index(data, workers):
+    """Returns the worker that handles the raw update, always the same one for a user"""
+    user_id = update_user_id(data)
+    return 0 if user_id is None else user_id % workers
+
+
+def run_worker(index, connection, create_updater, worker_init):
+    """Worker process body: feeds the updates received from the main process to its own dispatcher"""
+    # Inherited from the main process when restarted
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if worker_init is not None:
+        worker_init(index)
+
+    start = time.perf_counter()
+    updater = create_updater(run_jobs=index == 0)
+    dispatcher = updater.dispatcher
+    threading.Thread(target=dispatcher.start, name='dispatcher').start()
+    updater.job_queue.start()
+
+    def stop(signum, frame):
+        # A forked worker leaves through os._exit, the atexit functions (ex. the persistence flush) never run
+        logging.info("Worker %d stopping", index)
+        updater.job_queue.stop()
+        dispatcher.stop()
+        persistence = getattr(updater, 'persistence', None)
+        if persistence is not None:
+            persistence.flush()
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+
+    logging.info("Worker %d started in %.3fs", index, time.perf_counter() - start)
+    while True:
+        data = connection.recv()
+        dispatcher.update_queue.put(Update.de_json(data, updater.bot))
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+class WebhookCluster:
+    def __init__(self, token, workers, create_updater, worker_init=None):
+        self.token = token
+        self.create_updater = create_updater
+        self.worker_init = worker_init
+
+        # The handlers and the storage are already imported, fork avoids importing them again
+        self.context = multiprocessing.get_context('fork')
+        # A pipe per worker rather than a Queue: a worker killed while waiting on a Queue keeps its lock,
+        # and the restarted worker would never get an update again.
+        # The main process keeps both ends so that the updates in a pipe outlive its worker
+        self.pipes = [self.context.Pipe(duplex=False) for _ in range(workers)]
+        self.send_locks = [threading.Lock() for _ in range(workers)]
+        self.processes = [None] * workers
+
+    def _start_worker(self, index):
+        process = self.context.Process(
+            target=run_worker,
+            args=(index, self.pipes[index][0], self.create_updater, self.worker_init),
+            name='worker-%d' % index,
+            daemon=True,
+        )
+        process.start()
+        self.processes[index] = process
+
+    def restart_dead_workers(self):
+        for index, process in enumerate(self.processes):
+            if not process.is_alive():
+                logging.error("Worker %d died (exit code %s), restarting it, the updates it was handling are lost",
+                              index, process.exitcode)
+                self._start_worker(index)
+
+    def route(self, data):
+        index = worker_index(data, len(self.processes))
+        # Blocks the request while the pipe is full, Telegram then slows down
+        with self.send_locks[index]:
+            self.pipes[index][1].send(data)
+
+    def _request_handler(self):
+        cluster = self
+
+        class WebhookHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != '/' + cluster.token:
+                    self.send_error(403)
+                    return
+                length = int(self.headers.get('Content-Length', 0))
+                try:
+                    data = json.loads(self.rfile.read(length).decode('utf-8'))
+                except ValueError:
+                    self.send_error(400)
+                    return
+                cluster.route(data)
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logging.debug("Webhook: " + format, *args)
+
+        return WebhookHandler
+
+    def serve(self, url, port, set_webhook):
+        """Serves the webhook forever, set_webhook is called with the full url once the server is up"""
+        for index in range(len(self.processes)):
+            self._start_worker(index)
+
+        server = ThreadingHTTPServer(('0.0.0.0', port), self._request_handler())
+        threading.Thread(target=server.serve_forever, name='webhook', daemon=True).start()
+        set_webhook(url + self.token)
+        logging.info("Serving webhook at %s port %d with %d workers", url, port, len(self.processes))
+
+        signal.signal(signal.SIGTERM, _interrupt)
+        try:
+            while True:
+                multiprocessing.connection.wait([process.sentinel for process in self.processes])
+                self.restart_dead_workers()
+        except KeyboardInterrupt:
+            server.shutdown()
+            # The workers flush their data on SIGTERM
+            for process in self.processes:
+                process.terminate()
+            for process in self.processes:
+                process.join(WORKER_STOP_TIMEOUT)
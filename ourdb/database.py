@@ -0,0 +1,12 @@
+"""
+The storage shared by the bot and its modules
+
+bot.py runs as __main__, importing the storage from it would run it (and create the storage) a second time.
+"""
+import metrics
+from storage import DbStorage, StorageQueries
+
+storage = DbStorage()
+storage.init()
+metrics.instrument_engine(storage.engine)
+metrics.instrument_storage(storage, StorageQueries)
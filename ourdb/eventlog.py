@@ -0,0 +1,78 @@
+"""
+Structured logging for the hot paths
+
+An event is a name and some fields, rendered only when a handler actually emits the record:
+
+    events = EventLogger(__name__)
+    events.debug('get_entries', user_id=user_id, pack=pack_name, entries=res)
+
+gets logged as "get_entries user_id=1 pack='cats' entries=<120 items>", collections are always
+summarized by their size. The events logged with sampled=True are kept only with the probability set
+for their logger in LOG_SAMPLING, ex. LOG_SAMPLING=storage=0.01,modules.main.common=0.1
+"""
+import logging
+import os
+import random
+import sys
+
+# Longer strings are cut when rendered
+MAX_FIELD_LENGTH = 64
+
+
+def _parse_sampling(raw):
+    rates = {}
+    for item in raw.split(','):
+        if item.strip():
+            name, _, rate = item.partition('=')
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+LOG_SAMPLING = _parse_sampling(os.environ.get('LOG_SAMPLING', default=''))
+
+# Makes the records point to the caller of the EventLogger, stacklevel exists only since Python 3.8
+CALLER_FRAME = {'stacklevel': 3} if sys.version_info >= (3, 8) else {}
+
+
+def render_field(value):
+    if isinstance(value, (list, tuple, set, frozenset, dict)):
+        return '<%d items>' % len(value)
+    if isinstance(value, str) and len(value) > MAX_FIELD_LENGTH:
+        value = value[:MAX_FIELD_LENGTH] + '...'
+    return repr(value)
+
+
+class Event:
+    """Message of a log record, rendered by the handler that formats it (if any)"""
+
+    __slots__ = ('name', 'fields')
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join([self.name] + ['%s=%s' % (key, render_field(value)) for key, value in self.fields.items()])
+
+
+class EventLogger:
+    def __init__(self, name, sample_rate=None):
+        self.logger = logging.getLogger(name)
+        self.sample_rate = LOG_SAMPLING.get(name, 1.0) if sample_rate is None else sample_rate
+
+    def log(self, level, event, sampled=False, **fields):
+        if not self.logger.isEnabledFor(level):
+            return
+        if sampled and self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        # The fields are attached raw too, for the handlers that emit structured records
+        self.logger.log(level, Event(event, fields), extra={'event': event, 'fields': fields}, **CALLER_FRAME)
+
+    def debug(self, event, sampled=False, **fields):
+        self.log(logging.DEBUG, event, sampled, **fields)
+
+    def info(self, event, sampled=False, **fields):
+        self.log(logging.INFO, event, sampled, **fields)
+
+    def warning(self, event, sampled=False, **fields):
+        self.log(logging.WARNING, event, sampled, **fields)
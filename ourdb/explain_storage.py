@@ -0,0 +1,130 @@
+"""
+Runs EXPLAIN QUERY PLAN over every query issued by the DbStorage methods on a seeded SQLite database
+
+Prints the plan of each statement and exits with an error if any of them scans a whole table,
+or if a public StorageQueries method is neither in storage_calls nor in NOT_EXPLAINED,
+run it after changing a query or the schema: python3 ourdb/explain_storage.py
+"""
+import inspect
+import logging
+import os
+import re
+import sys
+import tempfile
+
+from sqlalchemy import event
+
+tmp_dir = tempfile.TemporaryDirectory()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmp_dir.name, 'explain.db')
+
+from storage import DbStorage, EntryType, StorageQueries
+
+USERS = 50
+PACKS_PER_USER = 10
+ENTRIES_PER_PACK = 20
+
+FULL_SCAN_REGEX = re.compile(r'\bSCAN (\w+)$')
+
+# The public StorageQueries methods left out of storage_calls, and why
+NOT_EXPLAINED = {
+    'init_schema': "runs once at startup",
+    'get_schema_version': "get_meta of a fixed key",
+    'set_schema_version': "set_meta of a fixed key",
+    'all_entries_query': "the statement run by iter_all_entries",
+    'reconcile_entry_counts': "counts every entry on purpose, in a periodic job and migrate.py",
+}
+
+
+def seed(storage):
+    with storage.session_scope() as session:
+        for user_id in range(USERS):
+            for pack in range(PACKS_PER_USER):
+                entries = [(EntryType.STICKER.value, 'sticker%d' % i) for i in range(ENTRIES_PER_PACK)]
+                entries.append((EntryType.PACK.value, 'set%d' % pack))
+                storage.import_pack(session, user_id, 'pack%d' % pack, entries)
+
+
+def storage_calls(storage, session):
+    """Every DbStorage method with some representative arguments"""
+    return [
+        ('get_packs', lambda: storage.get_packs(session, 1)),
+        ('has_pack', lambda: storage.has_pack(session, 1, 'pack1')),
+        ('get_entries', lambda: storage.get_entries(session, 1, 'pack1', False)),
+        ('get_entries similar', lambda: storage.get_entries(session, 1, 'pack%', True)),
+        ('search_packs', lambda: storage.search_packs(session, 1, 'ack1', 5)),
+        ('get_entry_layout', lambda: storage.get_entry_layout(session, 1, ['pack1', 'pack2'])),
+        ('get_plain_entries', lambda: storage.get_plain_entries(session, 1, 'pack1', 5, 10)),
+        ('get_existing_entries', lambda: storage.get_existing_entries(session, 1, ['pack1', 'pack2'])),
+        ('has_entry', lambda: storage.has_entry(session, 1, 'pack1', EntryType.STICKER, 'sticker1')),
+        ('add_entry', lambda: storage.add_entry(session, 1, 'pack1', EntryType.STICKER, 'new', only_remove=False)),
+        ('add_entry remove', lambda: storage.add_entry(session, 1, 'pack1', EntryType.STICKER, 'new')),
+        ('remove_every_pack_mention', lambda: storage.remove_every_pack_mention(session, 1, 'set1')),
+        ('import_pack', lambda: storage.import_pack(session, 1, 'pack2', [('s', 'sticker1'), ('s', 'other')])),
+        ('count_total_entries', lambda: storage.count_total_entries(session, 1)),
+        ('remove_pack', lambda: storage.remove_pack(session, 1, 'pack3')),
+        ('iter_all_entries', lambda: list(storage.iter_all_entries(session, 2))),
+        ('get_meta', lambda: storage.get_meta(session, 'key')),
+        ('set_meta', lambda: storage.set_meta(session, 'key', 'value')),
+        ('set_meta remove', lambda: storage.set_meta(session, 'key', None)),
+        ('save_user_data', lambda: storage.save_user_data(session, {1: b'data', 2: b'data'})),
+        ('load_user_data', lambda: storage.load_user_data(session, 1)),
+        ('save_conversation_states', lambda: storage.save_conversation_states(
+            session, 'conversation', {'[1, 1]': '1', '[2, 2]': '2'})),
+        ('save_conversation_states end', lambda: storage.save_conversation_states(
+            session, 'conversation', {'[2, 2]': None})),
+        ('load_conversation_states', lambda: storage.load_conversation_states(
+            session, ['conversation', 'other'], '[1, 1]')),
+    ]
+
+
+def missing_calls():
+    """Returns the public StorageQueries methods that are neither explained nor in NOT_EXPLAINED"""
+    explained = {name.split()[0] for name, _ in storage_calls(None, None)}
+    public = {name for name, _ in inspect.getmembers(StorageQueries, inspect.isfunction) if not name.startswith('_')}
+    return sorted(public - explained - set(NOT_EXPLAINED))
+
+
+def main():
+    logging.basicConfig(format='%(levelname)s - %(message)s', level=logging.WARNING)
+    missing = missing_calls()
+    if missing:
+        print('Add these StorageQueries methods to storage_calls (or to NOT_EXPLAINED): ' + ', '.join(missing))
+        sys.exit(1)
+
+    storage = DbStorage()
+    storage.init()
+    seed(storage)
+
+    statements = []
+
+    @event.listens_for(storage.engine, 'before_cursor_execute')
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        if not statement.startswith('EXPLAIN') and not executemany:
+            statements.append((statement, parameters))
+
+    full_scans = []
+    with storage.engine.connect() as explain_conn:
+        with storage.session_scope() as session:
+            for name, call in storage_calls(storage, session):
+                del statements[:]
+                call()
+                session.flush()
+                for statement, parameters in list(statements):
+                    plan = explain_conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+                    print('%s: %s' % (name, ' '.join(statement.split())))
+                    for row in plan:
+                        detail = row[-1]
+                        print('    ' + detail)
+                        if FULL_SCAN_REGEX.search(detail):
+                            full_scans.append((name, detail))
+                print()
+
+    if full_scans:
+        for name, detail in full_scans:
+            print('Full table scan in %s: %s' % (name, detail))
+        sys.exit(1)
+    print('No full table scans')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+"""
+In-process metrics, exposed in the Prometheus text format
+
+Recorded all the time (an observation is a lock and a few additions):
+- latency of every update, by update type, and of every handler callback
+- DB time and number of queries of every update, latency of every storage method
+- latency of every Telegram API call by method (see outbound.TimedRequest)
+
+start_metrics_server serves them at http://METRICS_HOST:METRICS_PORT/metrics
+
+The statements of every update are also fingerprinted (the values and the length of the IN lists and
+multi-row VALUES are left out): running the same one NPLUSONE_THRESHOLD times in a single update
+is logged as a likely N+1 pattern. With QUERY_STRICT=True (for tests) it raises QueryBudgetExceeded,
+query_budget checks a block of code against an explicit budget.
+"""
+import inspect
+import logging
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as CounterDict
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler
+
+from sqlalchemy import event
+from telegram import Update
+
+from cluster import UPDATE_FIELDS, ThreadingHTTPServer
+
+# 0 disables the endpoint, every cluster worker uses METRICS_PORT + its index
+METRICS_PORT = int(os.environ.get('METRICS_PORT', default=9464))
+METRICS_HOST = os.environ.get('METRICS_HOST', default='127.0.0.1')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+# Runs of the same statement in a single update that are reported as an N+1 pattern
+NPLUSONE_THRESHOLD = int(os.environ.get('NPLUSONE_THRESHOLD', default=10))
+QUERY_STRICT = os.environ.get('QUERY_STRICT', default='False') == 'True'
+
+registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values = {}
+        registry.append(self)
+
+    def _labels(self, labelvalues, extra=''):
+        labels = ','.join('%s="%s"' % (name, _escape(value)) for name, value in zip(self.labelnames, labelvalues))
+        if extra:
+            labels = labels + ',' + extra if labels else extra
+        return '{%s}' % labels if labels else ''
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.type)]
+        lines += ('%s%s %s' % (name, labels, repr(value)) for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for labelvalues, value in items:
+            yield self.name, self._labels(labelvalues), value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value, *labelvalues):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                # [count of every bucket (not cumulative) and of +Inf, sum]
+                state = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0]
+            state[0][index] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, *labelvalues):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def samples(self):
+        with self._lock:
+            items = [(labelvalues, list(counts), total) for labelvalues, (counts, total) in self._values.items()]
+        for labelvalues, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield self.name + '_bucket', self._labels(labelvalues, 'le="%s"' % bound), cumulative
+            yield self.name + '_sum', self._labels(labelvalues), total
+            yield self.name + '_count', self._labels(labelvalues), cumulative
+
+
+update_seconds = Histogram('ourdb_update_seconds', "Time spent handling an update", ('type',))
+update_db_seconds = Histogram('ourdb_update_db_seconds', "Time spent in the database while handling an update")
+update_db_queries = Histogram('ourdb_update_db_queries', "Queries made while handling an update",
+                              buckets=COUNT_BUCKETS)
+handler_seconds = Histogram('ourdb_handler_seconds', "Time spent in a handler callback", ('handler',))
+storage_seconds = Histogram('ourdb_storage_seconds', "Time spent in a storage method", ('method',))
+db_queries = Counter('ourdb_db_queries_total', "Queries sent to the database")
+api_seconds = Histogram('ourdb_api_seconds', "Duration of the Telegram API calls", ('method',))
+api_errors = Counter('ourdb_api_errors_total', "Telegram API calls that failed", ('method',))
+repeated_queries = Counter('ourdb_repeated_queries_total', "Updates that repeated a statement NPLUSONE_THRESHOLD times",
+                           ('handler',))
+outbound_wait_seconds = Histogram('ourdb_outbound_wait_seconds', "Time an API call waited in the outbound queue",
+                                  ('priority',))
+
+
+def render():
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+_PLACEHOLDER = r'(?:\?|%\(\w+\)s|%s|:\w+)'
+_PLACEHOLDER_LIST = re.compile(r'\(\s*%s(?:\s*,\s*%s)*\s*\)' % (_PLACEHOLDER, _PLACEHOLDER))
+_REPEATED_GROUPS = re.compile(r'\(\?\)(?:\s*,\s*\(\?\))+')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def fingerprint(statement):
+    """The shape of a statement: IN (?, ?, ?) and VALUES (?, ?), (?, ?) both become (?)"""
+    statement = _WHITESPACE.sub(' ', statement.strip())
+    statement = _PLACEHOLDER_LIST.sub('(?)', statement)
+    return _REPEATED_GROUPS.sub('(?)', statement)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class UpdateStats:
+    __slots__ = ('queries', 'db_seconds', 'statements', 'handler')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0
+        self.statements = CounterDict()  # fingerprint -> runs
+        self.handler = None
+
+    def add(self, other):
+        self.queries += other.queries
+        self.db_seconds += other.db_seconds
+        self.statements.update(other.statements)
+
+    def repeated(self, threshold=NPLUSONE_THRESHOLD):
+        """Returns the (fingerprint, runs) of the statements run at least threshold times"""
+        return [(statement, runs) for statement, runs in self.statements.items() if runs >= threshold]
+
+
+_local = threading.local()
+
+
+def current_update_stats():
+    """Stats of the update being handled by this thread, None outside of an update"""
+    return getattr(_local, 'update_stats', None)
+
+
+@contextmanager
+def collect_queries():
+    """Collects the queries made by this thread inside the block, they still count for the enclosing one"""
+    previous = current_update_stats()
+    stats = _local.update_stats = UpdateStats()
+    try:
+        yield stats
+    finally:
+        _local.update_stats = previous
+        if previous is not None:
+            previous.add(stats)
+
+
+@contextmanager
+def query_budget(max_queries, max_repeats=NPLUSONE_THRESHOLD):
+    """Raises QueryBudgetExceeded if the block makes more than max_queries queries or repeats a statement
+
+    Meant for tests and benchmarks, ex:
+
+        with query_budget(3):
+            view_pack(bot, update, 'cats', user_data)
+    """
+    with collect_queries() as stats:
+        yield stats
+    if stats.queries > max_queries:
+        raise QueryBudgetExceeded("%d queries made, the budget is %d" % (stats.queries, max_queries))
+    repeated = stats.repeated(max_repeats)
+    if repeated:
+        raise QueryBudgetExceeded("Statement run %d times: %s" % (repeated[0][1], repeated[0][0]))
+
+
+def report_repeated(stats):
+    """Logs the statements of an update that look like an N+1 pattern"""
+    repeated = stats.repeated()
+    if not repeated:
+        return
+    handler = stats.handler or 'unknown'
+    repeated_queries.inc(handler)
+    for statement, runs in repeated:
+        logging.getLogger(__name__).warning("Handler %s ran the same statement %d times: %s", handler, runs, statement)
+    if QUERY_STRICT:
+        raise QueryBudgetExceeded("Handler %s ran the same statement %d times: %s" % (handler, repeated[0][1],
+                                                                                    repeated[0][0]))
+
+
+def update_type(update):
+    return next((field for field in UPDATE_FIELDS if getattr(update, field, None)), 'other')
+
+
+def track_updates(process_update):
+    """Wraps Dispatcher.process_update to time every update and check its queries"""
+    @wraps(process_update)
+    def wrapped(update):
+        if not isinstance(update, Update):
+            return process_update(update)
+        start = time.perf_counter()
+        try:
+            with collect_queries() as stats:
+                return process_update(update)
+        finally:
+            update_seconds.observe(time.perf_counter() - start, update_type(update))
+            update_db_seconds.observe(stats.db_seconds)
+            update_db_queries.observe(stats.queries)
+            report_repeated(stats)
+    return wrapped
+
+
+def instrument_engine(engine):
+    """Counts the queries of the engine and their time, adding them to the current update"""
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        db_queries.inc()
+        stats = current_update_stats()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += elapsed
+            stats.statements[fingerprint(statement)] += 1
+
+
+def _timed(histogram, label, func):
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        with histogram.time(label):
+            return func(*args, **kwargs)
+    wrapped.__timed__ = True
+    return wrapped
+
+
+def _timed_handler(name, callback):
+    @wraps(callback)
+    def wrapped(*args, **kwargs):
+        stats = current_update_stats()
+        if stats is not None:
+            stats.handler = name
+        with handler_seconds.time(name):
+            return callback(*args, **kwargs)
+    wrapped.__timed__ = True
+    return wrapped
+
+
+def instrument_storage(storage, queries_class):
+    """Times every public query method of queries_class called on storage"""
+    for name, func in inspect.getmembers(queries_class, inspect.isfunction):
+        # Generators would be timed before running
+        if name.startswith('_') or inspect.isgeneratorfunction(func):
+            continue
+        setattr(storage, name, _timed(storage_seconds, name, getattr(storage, name)))
+
+
+def instrument_handlers(handlers):
+    """Times the callback of every handler, looking inside the ConversationHandlers and the CallbackRouters"""
+    for handler in handlers:
+        if hasattr(handler, 'entry_points'):
+            instrument_handlers(handler.entry_points)
+            instrument_handlers(handler.fallbacks)
+            for state_handlers in handler.states.values():
+                instrument_handlers(state_handlers)
+        elif hasattr(handler, 'routes'):
+            instrument_handlers(handler.routes.values())
+        elif hasattr(handler, 'callback') and not getattr(handler.callback, '__timed__', False):
+            handler.callback = _timed_handler(handler.callback.__name__, handler.callback)
+
+
+def start_metrics_server(port, host=METRICS_HOST):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info("Serving metrics at http://%s:%d/metrics", host, port)
+    return server
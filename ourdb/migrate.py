@@ -0,0 +1,162 @@
+"""
+Upgrades the database schema to the version required by the bot
+
+Every migration is idempotent and copies data in small batches, each in its own transaction,
+so it can be run while the old bot is serving traffic. Once the old bot is stopped, and before the
+new one starts, re-run it with --redo 1 to catch up with the writes made in the meantime: the catch-up
+makes the new tables match pack_entries, then renames pack_entries to pack_entries_migrated (or drops it
+with --drop-legacy) so that no later run can go back to it. The new bot refuses to start until then.
+
+Usage: python3 ourdb/migrate.py [--batch-size N] [--redo VERSION] [--drop-legacy]
+"""
+import argparse
+import logging
+import os
+
+from sqlalchemy import Column, Integer, String, MetaData, Table, inspect, select, delete, exists, and_, union, text
+
+from storage import DbStorage, SCHEMA_VERSION, LEGACY_TABLE, Base, Pack, Entry
+
+# Where the catch-up moves pack_entries, kept until someone drops it
+MIGRATED_LEGACY_TABLE = 'pack_entries_migrated'
+# Set between the first copy of pack_entries and the catch-up
+LEGACY_COPIED_KEY = 'pack_entries_copied'
+
+legacy_metadata = MetaData()
+
+legacy_pack_entries = Table(
+    LEGACY_TABLE, legacy_metadata,
+    Column('owner_id', Integer, nullable=False),
+    Column('pack_name', String(50), nullable=False),
+    Column('entry_type', String(1), nullable=False),
+    Column('entry_data', String(32), nullable=False),
+)
+
+
+def split_pack_entries(storage, batch_size, drop_legacy):
+    """Copies pack_entries into the normalized packs and entries tables, removing what pack_entries lost"""
+    if not inspect(storage.engine).has_table(LEGACY_TABLE):
+        return
+
+    legacy = legacy_pack_entries.c
+    with storage.session_scope() as session:
+        catching_up = storage.get_meta(session, LEGACY_COPIED_KEY) is not None
+        # The users that removed everything since the last run are only in packs
+        owners = sorted(row[0] for row in session.execute(
+            union(select(legacy.owner_id), select(Pack.owner_id))
+        ))
+
+    logging.info("Migrating the entries of %d users", len(owners))
+    for i in range(0, len(owners), batch_size):
+        batch = owners[i:i + batch_size]
+        with storage.session_scope() as session:
+            session.execute(delete(Entry).where(
+                Entry.pack_id.in_(select(Pack.id).where(Pack.owner_id.in_(batch))),
+                ~exists().where(
+                    Pack.id == Entry.pack_id,
+                    legacy.owner_id == Pack.owner_id,
+                    legacy.pack_name == Pack.name,
+                    legacy.entry_type == Entry.entry_type,
+                    legacy.entry_data == Entry.entry_data
+                )
+            ).execution_options(synchronize_session=False))
+            session.execute(delete(Pack).where(
+                Pack.owner_id.in_(batch),
+                ~exists().where(legacy.owner_id == Pack.owner_id, legacy.pack_name == Pack.name)
+            ).execution_options(synchronize_session=False))
+            session.execute(Pack.__table__.insert().from_select(
+                ['owner_id', 'name'],
+                select(legacy.owner_id, legacy.pack_name).distinct().where(
+                    legacy.owner_id.in_(batch),
+                    ~exists().where(Pack.owner_id == legacy.owner_id, Pack.name == legacy.pack_name)
+                )
+            ))
+            session.execute(Entry.__table__.insert().from_select(
+                ['pack_id', 'entry_type', 'entry_data'],
+                select(Pack.id, legacy.entry_type, legacy.entry_data)
+                .join(Pack, and_(Pack.owner_id == legacy.owner_id, Pack.name == legacy.pack_name))
+                .where(
+                    legacy.owner_id.in_(batch),
+                    ~exists().where(
+                        Entry.pack_id == Pack.id,
+                        Entry.entry_type == legacy.entry_type,
+                        Entry.entry_data == legacy.entry_data
+                    )
+                )
+            ))
+        logging.info("Migrated users %d/%d", min(i + batch_size, len(owners)), len(owners))
+
+    if drop_legacy:
+        legacy_pack_entries.drop(storage.engine)
+    elif catching_up:
+        with storage.session_scope() as session:
+            session.execute(text('ALTER TABLE %s RENAME TO %s' % (LEGACY_TABLE, MIGRATED_LEGACY_TABLE)))
+        logging.info("Caught up, %s renamed to %s", LEGACY_TABLE, MIGRATED_LEGACY_TABLE)
+    else:
+        # The old bot might still be writing to it
+        logging.info("Stop the old bot and run migrate.py --redo 1 to catch up with %s", LEGACY_TABLE)
+    with storage.session_scope() as session:
+        storage.set_meta(session, LEGACY_COPIED_KEY, None if drop_legacy or catching_up else '1')
+
+
+def create_indexes(storage, batch_size, drop_legacy):
+    """Creates the indexes missing from the tables made by older versions"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(storage.engine, checkfirst=True)
+
+
+def count_entries(storage, batch_size, drop_legacy):
+    """Fills the per-user entry counters"""
+    with storage.session_scope() as session:
+        storage.reconcile_entry_counts(session)
+
+
+def create_tables(storage, batch_size, drop_legacy):
+    """Creates the tables added by the new version"""
+    Base.metadata.create_all(storage.engine)
+
+
+# (version, migration), applied in order to every database older than version
+MIGRATIONS = [
+    (1, split_pack_entries),
+    (2, create_indexes),
+    (3, count_entries),
+    (4, create_tables),
+]
+
+
+def migrate(storage, batch_size=100, drop_legacy=False, redo=None):
+    storage.init(upgrading=True)
+
+    with storage.session_scope() as session:
+        version = storage.get_schema_version(session) or 0
+    if redo is not None:
+        version = min(version, redo - 1)
+
+    for migration_version, migration in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        logging.info("Migrating to version %d: %s", migration_version, migration.__doc__)
+        migration(storage, batch_size, drop_legacy)
+        with storage.session_scope() as session:
+            storage.set_schema_version(session, migration_version)
+
+    logging.info("Database at schema version %d", SCHEMA_VERSION)
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=int(os.environ.get('LOG_LEVEL', default=logging.INFO)))
+
+    parser = argparse.ArgumentParser(description="Upgrade the OurDB database schema")
+    parser.add_argument('--batch-size', type=int, default=100, help="users migrated per transaction")
+    parser.add_argument('--redo', type=int, help="apply again every migration starting from this version")
+    parser.add_argument('--drop-legacy', action='store_true', help="drop the old tables once migrated")
+    args = parser.parse_args()
+
+    migrate(DbStorage(), args.batch_size, args.drop_legacy, args.redo)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,22 @@
 import logging
-import os
-
-# Select all direct subdirectories
 from importlib import import_module
-from pathlib import Path
 
-search_dir = Path(__file__).parent
-submodules_names = next(os.walk(search_dir))[1]
+from callback import route_callbacks
 
-submodules_names = [submod for submod in submodules_names if os.path.isfile(search_dir / submod / '__init__.py')]
+# Every submodule with handlers, in registration order (add the new ones here)
+SUBMODULES = (
+    'limits',
+    'main',
+    'export',
+    'info',
+)
 
-logging.info("Loading submodules: " + str(submodules_names))
+logging.info("Loading submodules: " + str(SUBMODULES))
 # Load them as modules
-submodules = [import_module('modules.' + submodule_name) for submodule_name in submodules_names]
+submodules = [import_module('modules.' + submodule_name) for submodule_name in SUBMODULES]
 
-# Select their handles
-__handlers__ = [handle for submodule in submodules for handle in submodule.__handlers__]
+# Select their handles, a single router dispatches the top-level callback queries
+__handlers__ = route_callbacks([handle for submodule in submodules for handle in submodule.__handlers__])
+# Select their persistent conversations
+__conversations__ = {name: handler for submodule in submodules
+                     for name, handler in getattr(submodule, '__conversations__', {}).items()}
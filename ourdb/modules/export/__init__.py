@@ -1,3 +1,4 @@
 from modules.export import import_pack, export_pack
 
 __handlers__ = import_pack.__handlers__ + export_pack.__handlers__
+__conversations__ = import_pack.__conversations__
@@ -1,9 +1,13 @@
+import gzip
 import json
-from io import BytesIO
+from io import BytesIO, TextIOWrapper
+from itertools import groupby
+from operator import itemgetter
 
 from telegram import Bot
+from telegram.ext import CommandHandler
 
-from bot import storage, CommandHandler
+from database import storage
 from botutils import edit_or_send, strip_command
 from callback import CallbackCommandHandler
 from modules.main.common import create_select_sticker_menu
@@ -11,18 +15,49 @@ from modules.main.common import create_select_sticker_menu
 EXPORT_CHAR = '>'
 
 
+def _dumps(value):
+    return json.dumps(value, check_circular=False, separators=(',', ':'))
+
+
+def write_export(out, packs):
+    """Writes the version 1.0 document to the text stream out, one entry at a time
+
+    packs is an iterable of (name, entries) and entries an iterable of (entry_type, entry_data)
+    """
+    out.write('{"version":"1.0","packs":[')
+    for i, (name, entries) in enumerate(packs):
+        out.write((',' if i else '') + '{"name":' + _dumps(name) + ',"entries":[')
+        for j, entry in enumerate(entries):
+            out.write((',' if j else '') + _dumps(list(entry)))
+        out.write(']}')
+    out.write(']}')
+
+
 def export_json(packs):
-    processed = {
-        'version': '1.0',
-        'packs': [
-            {
-                'name': pack[0],
-                'entries': pack[1]
-            } for pack in packs
-        ]
-    }
-    raw_out = bytes(json.dumps(processed, check_circular=False, separators=(',', ':')), 'utf-8')
-    return BytesIO(raw_out)
+    out = BytesIO()
+    text = TextIOWrapper(out, encoding='utf-8')
+    write_export(text, packs)
+    text.detach()  # Flushes without closing out
+    out.seek(0)
+    return out
+
+
+def export_all_json(user_id):
+    """Returns a gzip-compressed export of every pack of the user, streamed from the database
+
+    Only the compressed document is kept in memory, not the rows nor the JSON. It's kept whole though:
+    python-telegram-bot reads the entire file to upload it, spooling it to disk would save nothing.
+    """
+    out = BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as compressed:
+        text = TextIOWrapper(compressed, encoding='utf-8')
+        with storage.session_scope() as session:
+            rows = storage.iter_all_entries(session, user_id)
+            write_export(text, ((name, (row[1:] for row in pack_rows))
+                                for name, pack_rows in groupby(rows, key=itemgetter(0))))
+        text.detach()
+    out.seek(0)
+    return out
 
 
 def export_pack(bot: Bot, update, pack):
@@ -54,7 +89,20 @@ def on_export_command(bot, update):
     return export_pack(bot, update, pack)
 
 
+def on_export_all_command(bot, update):
+    user_id = update.effective_user.id
+
+    with storage.session_scope() as session:
+        if storage.count_total_entries(session, user_id) == 0:
+            bot.send_message(user_id, "You have nothing to export")
+            return
+
+    out_buf = export_all_json(user_id)
+    bot.send_document(chat_id=user_id, document=out_buf, filename="ourdb_export.json.gz")
+
+
 __handlers__ = (
     CommandHandler('export', on_export_command),
+    CommandHandler('exportall', on_export_all_command),
     CallbackCommandHandler(EXPORT_CHAR, export_pack, pass_data=True),
 )
@@ -1,4 +1,3 @@
-import json
 import logging
 from enum import Enum
 from io import BytesIO
@@ -7,11 +6,11 @@ from typing import List
 from telegram import ReplyKeyboardMarkup, Update, Bot
 from telegram.ext import ConversationHandler, CommandHandler, MessageHandler, RegexHandler, Filters
 
-from bot import storage
+from database import storage
 from modules import limits
+from modules.export.import_parser import ImportFileError, parse_import, open_import_file, IMPORT_MAX_SIZE
 from modules.main.cancel import cancel_markup
 from modules.main.menu import start_menu_markup
-from storage import EntryType
 
 IMPORT_CHAR = '<'
 
@@ -36,16 +35,14 @@ class ImportEntry:
         self.conflict_resolution = None
         self.added_medias = 0
 
-    def initialize(self, session):
+    def initialize(self, existing_entries):
+        """existing_entries is the set of (entry_type, entry_data) already in the pack, None if there's no such pack"""
         self.initialized = True
-        if storage.has_pack(session, self.user_id, self.name):
+        new_entries = {(entry_type, entry_data) for entry_type, entry_data in self.entries}
+        if existing_entries is not None:
             self.conflict = True
-            for entry_type, entry_data in self.entries:
-                if not storage.has_entry(session, self.user_id, self.name, EntryType(entry_type), entry_data):
-                    self.added_medias += 1
-
-        else:
-            self.added_medias = len(self.entries)
+            new_entries -= existing_entries
+        self.added_medias = len(new_entries)
 
     def import_pack(self, session):
         if self.conflict:
@@ -67,16 +64,15 @@ class ImportSession:
         self.current_conflict = None
         self.last_confirm = False
 
-    def on_receive_file(self, raw_content):
+    def on_receive_file(self, file_data):
+        """Reads the packs of the import file (a binary stream), returns the error message if it's not valid"""
         try:
-            self.analyze_json_sanity(raw_content)
-        except ValueError as e:
-            logging.exception("Exception during import")
-            return e.args
-        except Exception:
-            return "Invalid file"
-
-        self.initialize_from_json(raw_content)
+            with open_import_file(file_data) as text:
+                self.initialize_from_packs(parse_import(text))
+        except ImportFileError as e:
+            logging.info("Import file rejected: %s", e)
+            self.imports = None
+            return str(e)
 
     def next_unresolved_conflicts(self):
         for entry in self.imports:
@@ -89,32 +85,13 @@ class ImportSession:
         assert self.current_conflict is not None
         self.current_conflict.conflict_resolution = method
 
-    def analyze_json_sanity(self, raw):
-        if raw['version'] != '1.0':
-            raise ValueError('Version not supported')
-
-        packs = raw['packs']
-
-        for pack in packs:
-            assert isinstance(pack['name'], str)
-            entries = pack['entries']
-            for entry in entries:
-                assert isinstance(entry, list)
-                assert len(entry) == 2
-                entry_type, entry_data = entry
-                # check if the entry exists
-                assert EntryType.has_value(entry_type)
-                # TODO: assert entries[0] in SUPPORTED_CHARS
-
-    def initialize_from_json(self, raw):
-        packs = raw['packs']
-        self.imports = []
+    def initialize_from_packs(self, packs):
+        self.imports = [ImportEntry(self.user_id, raw_pack) for raw_pack in packs]
 
         with storage.session_scope() as session:
-            for raw_pack in packs:
-                import_entry = ImportEntry(self.user_id, raw_pack)
-                self.imports.append(import_entry)
-                import_entry.initialize(session)
+            existing = storage.get_existing_entries(session, self.user_id, [entry.name for entry in self.imports])
+        for import_entry in self.imports:
+            import_entry.initialize(existing.get(import_entry.name))
 
     def import_json(self):
         if not limits.check_insertion(self.user_id, inserted_count=self.new_media_count):
@@ -222,12 +199,25 @@ def on_import_command(bot, update, user_data):
 
 def on_file_selected(bot: Bot, update: Update, user_data):
     importer = user_data['import_data']  # type: ImportSession
-    file = bot.get_file(update.message.document.file_id)
+    document = update.message.document
+    file_size = document.file_size
+    file = None
+    if file_size is None:
+        # The size is optional in both, never download a file that can't be checked
+        file = bot.get_file(document.file_id)
+        file_size = file.file_size
+    if file_size is None:
+        bot.send_message(update.effective_user.id, "Cannot check the size of the file, please send it again")
+        return next_import_step(bot, update, user_data)
+    if file_size > IMPORT_MAX_SIZE:
+        bot.send_message(update.effective_user.id, "File too big, max size: %d KB" % (IMPORT_MAX_SIZE // 1024))
+        return next_import_step(bot, update, user_data)
+
+    file = file or bot.get_file(document.file_id)
     with BytesIO() as file_data:
         file.download(out=file_data)
-        file_str = str(file_data.getbuffer(), 'utf-8')
-    json_data = json.loads(file_str)
-    error = importer.on_receive_file(json_data)
+        file_data.seek(0)
+        error = importer.on_receive_file(file_data)
     if error is not None:
         bot.send_message(update.effective_user.id, error)
     return next_import_step(bot, update, user_data)
@@ -269,24 +259,30 @@ def on_cancel(bot, update, user_data):
     return ConversationHandler.END
 
 
-__handlers__ = (
-    ConversationHandler(
-        entry_points=[
-            CommandHandler('import', on_import_command, pass_user_data=True)
-        ],
-        states={
-            SELECT_FILE: {
-                MessageHandler(Filters.document, on_file_selected, pass_user_data=True)
-            },
-            RESOLVE_CONFLICT: [
-                RegexHandler('^(Override|Merge|Skip|Cancel)$', on_resolve_answer, pass_user_data=True)
-            ],
-            LAST_CONFIRM: [
-                RegexHandler('^(Confirm|Cancel)$', on_last_confirm, pass_user_data=True)
-            ],
+import_conversation_handler = ConversationHandler(
+    entry_points=[
+        CommandHandler('import', on_import_command, pass_user_data=True)
+    ],
+    states={
+        SELECT_FILE: {
+            MessageHandler(Filters.document, on_file_selected, pass_user_data=True)
         },
-        fallbacks=[
-            CommandHandler('cancel', on_cancel, pass_user_data=True)
-        ]
-    ),
+        RESOLVE_CONFLICT: [
+            RegexHandler('^(Override|Merge|Skip|Cancel)$', on_resolve_answer, pass_user_data=True)
+        ],
+        LAST_CONFIRM: [
+            RegexHandler('^(Confirm|Cancel)$', on_last_confirm, pass_user_data=True)
+        ],
+    },
+    fallbacks=[
+        CommandHandler('cancel', on_cancel, pass_user_data=True)
+    ]
 )
+
+__handlers__ = (
+    import_conversation_handler,
+)
+
+__conversations__ = {
+    'import': import_conversation_handler,
+}
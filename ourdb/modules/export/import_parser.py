@@ -0,0 +1,187 @@
+"""
+Incremental parser of the export files
+
+The file is read in small chunks and the packs and their entries are decoded one at a time, so a file
+is rejected as soon as its size exceeds IMPORT_MAX_SIZE or a malformed pack shows up, without loading
+the rest of it. Every other value must fit in MAX_VALUE_SIZE, a value is decoded again after every
+chunk it spans.
+Gzip-compressed files (like the /exportall ones) are detected and decompressed on the fly.
+"""
+import gzip
+import json
+import os
+import re
+import zlib
+from io import TextIOWrapper
+
+from modules.main.common import MAX_PACK_NAME_LENGTH
+from storage import EntryType
+
+# Max size of an import file, compressed or not
+IMPORT_MAX_SIZE = int(os.environ.get('IMPORT_MAX_SIZE', default=5 * 1024 * 1024))
+READ_CHUNK_SIZE = 64 * 1024
+# Max length of a single value (ex. an entry), way more than any valid one
+MAX_VALUE_SIZE = 4 * 1024
+
+GZIP_MAGIC = b'\x1f\x8b'
+WHITESPACE = re.compile(r'\s*')
+decoder = json.JSONDecoder()
+
+
+class ImportFileError(ValueError):
+    pass
+
+
+class _Reader:
+    """Buffered reader of a text stream, the buffer holds at most one (small) value and a chunk"""
+
+    def __init__(self, stream, max_size):
+        self.stream = stream
+        self.max_size = max_size
+        self.read_size = 0
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.eof:
+            return False
+        try:
+            chunk = self.stream.read(READ_CHUNK_SIZE)
+        except (UnicodeDecodeError, OSError, EOFError, zlib.error):
+            raise ImportFileError("Invalid file")
+        if not chunk:
+            self.eof = True
+            return False
+        self.read_size += len(chunk)
+        if self.read_size > self.max_size:
+            raise ImportFileError("File too big, max size: %d KB" % (self.max_size // 1024))
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Returns the next non-whitespace character without consuming it ('' at the end of the file)"""
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def accept(self, char):
+        if self.peek() != char:
+            return False
+        self.pos += 1
+        return True
+
+    def expect(self, char):
+        if not self.accept(char):
+            raise ImportFileError("Invalid file")
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if len(self.buffer) - self.pos > MAX_VALUE_SIZE or not self._fill():
+                    raise ImportFileError("Invalid file")
+                continue
+            # A number might go on in the next chunk
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def _parse_array(reader, parse_item):
+    """Yields the items of a JSON array, each one parsed by parse_item(reader)"""
+    reader.expect('[')
+    if reader.accept(']'):
+        return
+    while True:
+        yield parse_item(reader)
+        if reader.accept(']'):
+            return
+        reader.expect(',')
+
+
+def _parse_entry(reader, pack_name):
+    entry = reader.value()
+    if not isinstance(entry, list) or len(entry) != 2 or not isinstance(entry[1], str) \
+            or not EntryType.has_value(entry[0]):
+        # The exports write the name first
+        raise ImportFileError("Invalid entry in pack " + pack_name if isinstance(pack_name, str) else "Invalid entry")
+    return entry
+
+
+def _parse_pack(reader):
+    name = None
+    entries = None
+
+    reader.expect('{')
+    if not reader.accept('}'):
+        while True:
+            key = reader.value()
+            reader.expect(':')
+            if key == 'entries':
+                entries = list(_parse_array(reader, lambda reader: _parse_entry(reader, name)))
+            else:
+                value = reader.value()
+                if key == 'name':
+                    name = value
+            if reader.accept('}'):
+                break
+            reader.expect(',')
+
+    if not isinstance(name, str) or entries is None:
+        raise ImportFileError("Invalid file")
+    if len(name) > MAX_PACK_NAME_LENGTH:
+        raise ImportFileError("Pack name too long: " + name[:MAX_PACK_NAME_LENGTH])
+    return {'name': name, 'entries': entries}
+
+
+def parse_import(stream, max_size=IMPORT_MAX_SIZE):
+    """Yields the packs ({'name': ..., 'entries': [...]}) of a version 1.0 export read from the text stream
+
+    Raises ImportFileError as soon as something is wrong, the packs already yielded should be discarded
+    """
+    reader = _Reader(stream, max_size)
+    version = None
+    has_packs = False
+
+    reader.expect('{')
+    if not reader.accept('}'):
+        while True:
+            key = reader.value()
+            reader.expect(':')
+            if key == 'packs':
+                # The exports always start with the version, don't read the packs of unknown ones
+                if version != '1.0':
+                    raise ImportFileError("Version not supported")
+                has_packs = True
+                yield from _parse_array(reader, _parse_pack)
+            else:
+                value = reader.value()
+                if key == 'version':
+                    version = value
+            if reader.accept('}'):
+                break
+            reader.expect(',')
+    if reader.peek():
+        raise ImportFileError("Invalid file")
+
+    if version != '1.0':
+        raise ImportFileError("Version not supported")
+    if not has_packs:
+        raise ImportFileError("Invalid file")
+
+
+def open_import_file(data):
+    """Returns a text stream of the binary file data, decompressing it if it's gzipped"""
+    compressed = data.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+    data.seek(0)
+    if compressed:
+        data = gzip.GzipFile(fileobj=data, mode='rb')
+    return TextIOWrapper(data, encoding='utf-8')
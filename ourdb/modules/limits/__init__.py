@@ -4,7 +4,7 @@ import math
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import CommandHandler
 
-from bot import storage
+from database import storage
 from callback import CallbackCommandHandler
 
 MAX_ENTRIES = int(os.environ.get('ENTRY_LIMIT'))
@@ -3,6 +3,7 @@
 
 from telegram.ext import ConversationHandler
 
+from callback import route_callbacks
 from modules.main import add_media, add_subpack, cancel, create, menu, remove, view, inline
 
 conversation_parts = [
@@ -21,7 +22,7 @@ conversation_states = {k: v for d in conversation_parts for k, v in d.__states__
 
 
 conversation_handler = ConversationHandler(
-    entry_points=conversation_handlers,
+    entry_points=route_callbacks(conversation_handlers),
     states=conversation_states,
     fallbacks=[],
     allow_reentry=True,
@@ -32,4 +33,9 @@ __handlers__ = (
     conversation_handler,
 )
 
+# Conversations whose state is kept in the database, by name
+__conversations__ = {
+    'main': conversation_handler,
+}
+
 
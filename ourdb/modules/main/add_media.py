@@ -3,7 +3,7 @@ import logging
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import CommandHandler, MessageHandler, Filters
 
-from bot import storage
+from database import storage
 from botutils import edit_or_send, strip_command
 from callback import CallbackCommandHandler
 from modules import limits
@@ -1,9 +1,9 @@
 import logging
 
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import CommandHandler
+from telegram.ext import CommandHandler, MessageHandler, Filters
 
-from bot import storage, MessageHandler, Filters
+from database import storage
 from botutils import edit_or_send, strip_command
 from callback import CallbackCommandHandler
 from modules import limits
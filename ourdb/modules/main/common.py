@@ -1,14 +1,23 @@
-import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.error import BadRequest
 
-from bot import storage
+from database import storage
 from botutils import build_menu
+from cache import TtlLruCache
+from eventlog import EventLogger
 from storage import EntryType
 
 MAX_PACK_NAME_LENGTH = 50
 
+# Sticker sets are shared between users, the cache size is measured in stickers
+STICKER_CACHE_SIZE = int(os.environ.get('STICKER_CACHE_SIZE', default=50000))
+STICKER_CACHE_TTL = int(os.environ.get('STICKER_CACHE_TTL', default=60 * 10))
+# Max sticker sets fetched at the same time
+STICKER_FETCH_WORKERS = int(os.environ.get('STICKER_FETCH_WORKERS', default=8))
+
 ADD_MEDIA_CHAR = 'a'
 ADD_SUBPACK_CHAR = 'p'
 CREATE_PACK_CHAR = 'c'
@@ -20,6 +29,14 @@ VIEW_PACK_CHAR = 'v'
 
 back_button = InlineKeyboardButton('Back', callback_data=VIEW_MENU_CHAR)
 
+sticker_set_cache = TtlLruCache(STICKER_CACHE_SIZE, STICKER_CACHE_TTL, sizeof=lambda pack: len(pack.stickers) + 1)
+# Sticker counts outlive the sets themselves so that pages can skip whole sets without fetching them
+sticker_set_sizes = TtlLruCache(STICKER_CACHE_SIZE, STICKER_CACHE_TTL * 6)
+
+events = EventLogger(__name__)
+
+sticker_fetch_executor = ThreadPoolExecutor(max_workers=STICKER_FETCH_WORKERS, thread_name_prefix='sticker_fetch')
+
 
 def create_select_sticker_menu(user_id, callback_char, send_add_button=True, send_back_button=True):
     with storage.session_scope() as session:
@@ -35,26 +52,96 @@ def create_select_sticker_menu(user_id, callback_char, send_add_button=True, sen
     return InlineKeyboardMarkup(menu)
 
 
-def get_pack_entries(bot, user_id, pack_name, offset, limit=1000000, similar=False):
+def _download_sticker_set(bot, name):
+    pack = bot.get_sticker_set(name)
+    sticker_set_cache.put(name, pack)
+    sticker_set_sizes.put(name, len(pack.stickers))
+    return pack
+
+
+def get_sticker_set(bot, name):
+    """Returns the sticker set with the given name, fetching it only when it's not cached
+
+    Raises BadRequest if the sticker set does not exist (anymore)
+    """
+    pack = sticker_set_cache.get(name)
+    if pack is None:
+        pack = _download_sticker_set(bot, name)
+    return pack
+
+
+def _fetch_sticker_set(bot, name, get=get_sticker_set):
+    try:
+        return get(bot, name)
+    except BadRequest as e:
+        return e
+
+
+def fetch_sticker_sets(bot, names):
+    """Returns a dict mapping every name to its set or BadRequest, downloading the missing sets concurrently"""
+    result = {}
+    missing = []
+    for name in names:
+        pack = sticker_set_cache.get(name)
+        if pack is None:
+            missing.append(name)
+        else:
+            result[name] = pack
+
+    if len(missing) <= 1:
+        result.update((name, _fetch_sticker_set(bot, name, _download_sticker_set)) for name in missing)
+    else:
+        result.update(zip(missing, sticker_fetch_executor.map(
+            lambda name: _fetch_sticker_set(bot, name, _download_sticker_set), missing)))
+    return result
+
+
+def _window_sticker_sets(layout, offset, end):
+    """Returns the sticker sets that might have entries inside the window"""
+    # Sets with an unknown size are counted as empty, so that they're never left out
+    position = 0
+    needed = []
+    for name, sticker_sets, plain_count in layout:
+        for sticker_set in sticker_sets:
+            if position >= end:
+                return needed
+            size = sticker_set_sizes.get(sticker_set)
+            if size is None or position + size > offset:
+                needed.append(sticker_set)
+            position += size or 0
+        position += plain_count
+    return needed
+
+
+def get_pack_entries(bot, user_id, pack_names, offset, limit=1000000):
+    """Returns a window of the entries of the packs (one after the other) and whether there are more"""
     assert limit > 0
     with storage.session_scope() as session:
-        entries = storage.get_entries(session, user_id, pack_name, similar)
+        layout = storage.get_entry_layout(session, user_id, pack_names)
+
+    # Get the sets of the window all at once, the rest of the function only reads them
+    fetched = fetch_sticker_sets(bot, _window_sticker_sets(layout, offset, offset + limit))
+
     discard_remaining = offset
     remaining = limit
     result = []
     more = False
-    for entry_type, entry in entries:
-        logging.debug("e: %s, discard_remaining: %s, remaining: %s, result: %s", (entry_type, entry), discard_remaining, remaining, len(result))
-        if remaining <= 0:
-            more = True
-            break
-
-        entry_type = EntryType(entry_type)
-        if entry_type == EntryType.PACK:
-            try:
-                pack = bot.get_sticker_set(entry)
-            except BadRequest:
-                on_stickerpack_removed(bot, user_id, entry)
+    for name, sticker_sets, plain_count in layout:
+        events.debug('expand_pack', sampled=True, pack=name, sticker_sets=sticker_sets, plain=plain_count,
+                     discard_remaining=discard_remaining, remaining=remaining)
+        for sticker_set in sticker_sets:
+            if remaining <= 0:
+                return result, True
+
+            # Whole sets before the requested window can be skipped without fetching them
+            size = sticker_set_sizes.get(sticker_set)
+            if size is not None and size <= discard_remaining:
+                discard_remaining -= size
+                continue
+
+            pack = fetched.get(sticker_set) or _fetch_sticker_set(bot, sticker_set)
+            if isinstance(pack, BadRequest):
+                on_stickerpack_removed(bot, user_id, sticker_set)
                 continue
             stickers = pack.stickers
             if len(stickers) <= discard_remaining:
@@ -69,25 +156,28 @@ def get_pack_entries(bot, user_id, pack_name, offset, limit=1000000, similar=Fal
 
             remaining -= len(stickers)
             result += ((EntryType.STICKER, sticker.file_id) for sticker in stickers)
-            # Temporarily remove local sticker pack support
-            '''elif entry_type == EntryType.LOCAL_PACK:
-            stickers, pack_more = get_pack_entries(bot, user_id, entry, discard_remaining, limit - len(result))
-            remaining -= len(stickers)
-            if remaining == 0:
-                more = pack_more
-            result += stickers'''
-        elif discard_remaining:
-            discard_remaining -= 1
-        else:
-            remaining -= 1
-            result.append((entry_type, entry))
-        logging.debug("DiscardRem: %s, res: %s", discard_remaining, len(result))
-    assert discard_remaining == 0
+
+        if plain_count <= discard_remaining:
+            discard_remaining -= plain_count
+            continue
+        if remaining <= 0:
+            return result, True
+
+        with storage.session_scope() as session:
+            entries = storage.get_plain_entries(session, user_id, name, discard_remaining, remaining)
+        if plain_count - discard_remaining > remaining:
+            more = True
+        discard_remaining = 0
+        remaining -= len(entries)
+        result += ((EntryType(entry_type), entry) for entry_type, entry in entries)
+        events.debug('expanded_plain_entries', sampled=True, pack=name, entries=entries, result=result)
     return result, more
 
 
 def on_stickerpack_removed(bot, user_id, stickerpack_name):
     """Called whenever a stickerpack of a user gets removed"""
+    sticker_set_cache.invalidate(stickerpack_name)
+    sticker_set_sizes.invalidate(stickerpack_name)
     bot.send_message(user_id, "The sticker pack %s has been removed, sorry for the inconvenience" % stickerpack_name)
     with storage.session_scope() as session:
         storage.remove_every_pack_mention(session, user_id, stickerpack_name)
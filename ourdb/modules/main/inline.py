@@ -1,14 +1,28 @@
 import logging
+import os
 
 from telegram import InlineQueryResultCachedSticker, InlineQueryResultCachedGif
 from telegram.error import BadRequest
 from telegram.ext import InlineQueryHandler
 
+from database import storage
 from botutils import is_valid_deeplink
+from cache import TtlLruCache
 from modules.main.common import MAX_PACK_NAME_LENGTH, get_pack_entries, CREATE_PACK_CHAR
 from storage import EntryType
 
 MAX_INLINE_RESULTS = 50
+# Packs expanded by a single query, the best matches first
+INLINE_MAX_PACKS = int(os.environ.get('INLINE_MAX_PACKS', default=5))
+
+# Expanded query results, the cache size is measured in entries
+INLINE_CACHE_SIZE = int(os.environ.get('INLINE_CACHE_SIZE', default=200000))
+INLINE_CACHE_TTL = int(os.environ.get('INLINE_CACHE_TTL', default=60 * 5))
+
+# user_id -> {query: [(entry_type, entry), ...]}
+inline_result_cache = TtlLruCache(INLINE_CACHE_SIZE, INLINE_CACHE_TTL,
+                                  sizeof=lambda results: sum(len(entries) + 1 for entries in results.values()))
+storage.add_change_listener(inline_result_cache.invalidate)
 
 
 def _inline_query_result_from_entry(entry_type, entry):
@@ -18,6 +32,20 @@ def _inline_query_result_from_entry(entry_type, entry):
         return InlineQueryResultCachedGif(id=entry, gif_file_id=entry)
 
 
+def get_query_entries(bot, user_id, query):
+    """Returns every entry of the packs matched by the query, expanding them only on the first request"""
+    user_results = inline_result_cache.get(user_id, {})
+    entries = user_results.get(query)
+    if entries is None:
+        with storage.session_scope() as session:
+            pack_names = storage.search_packs(session, user_id, query, INLINE_MAX_PACKS)
+        entries, _ = get_pack_entries(bot, user_id, pack_names, 0)
+        user_results = dict(user_results)
+        user_results[query] = entries
+        inline_result_cache.put(user_id, user_results)
+    return entries
+
+
 def on_inline_query(bot, update):
     query = update.inline_query.query
     if not query:
@@ -34,11 +62,13 @@ def on_inline_query(bot, update):
     query = query.lower()
     offset = 0 if not update.inline_query.offset else int(update.inline_query.offset)
     real_offset = offset * MAX_INLINE_RESULTS
-    entries, more = get_pack_entries(bot, update.effective_user.id, query, real_offset, MAX_INLINE_RESULTS, similar=True)
+    all_entries = get_query_entries(bot, update.effective_user.id, query)
+    entries = all_entries[real_offset:real_offset + MAX_INLINE_RESULTS]
+    more = len(all_entries) > real_offset + MAX_INLINE_RESULTS
     if entries:
         res_offset = offset + 1 if more else None
 
-        logging.debug("Entries: %s, offset: %s %s, res_offset: %s" % (len(entries), more, offset, res_offset))
+        logging.debug("Entries: %s, offset: %s %s, res_offset: %s", len(entries), more, offset, res_offset)
 
         try:
             bot.answer_inline_query(
@@ -1,4 +1,6 @@
-from bot import storage, CommandHandler
+from telegram.ext import CommandHandler
+
+from database import storage
 from botutils import edit_or_send, strip_command
 from callback import CallbackCommandHandler
 from modules.main.common import create_select_sticker_menu, REMOVE_PACK_CHAR
@@ -4,7 +4,7 @@ from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.error import BadRequest
 from telegram.ext import CommandHandler
 
-from botutils import edit_or_send, lookahead, strip_command
+from botutils import edit_or_send, lookahead, strip_command, when_all_done
 from callback import CallbackCommandHandler
 from modules.main.common import create_select_sticker_menu, get_pack_entries, VIEW_PACK_CHAR, ADD_MEDIA_CHAR, \
     ADD_SUBPACK_CHAR, REMOVE_PACK_CHAR, VIEW_MENU_CHAR
@@ -14,6 +14,38 @@ MAX_VIEW_RESULTS = 25
 OFFSET_DIVIDER = '|'
 
 
+def _on_deleted(future):
+    error = future.exception()
+    if isinstance(error, BadRequest):
+        # Already deleted by the user or too old to be deleted
+        logging.debug("Cannot delete message: %s", error)
+    elif error is not None:
+        logging.warning("Cannot delete message: %s", error)
+
+
+def delete_messages(bot, chat_id, message_ids):
+    """Queues the deletion of the messages without waiting for it"""
+    for message_id in message_ids:
+        bot.submit('delete_message', chat_id=chat_id, message_id=message_id).add_done_callback(_on_deleted)
+
+
+def is_stale_navigation(update, arg, user_data):
+    """True if a Back/Next button of a page that has already been replaced got pressed (ex. a double tap)
+
+    The page of a navigation is sent in the background, so the pressed message is recorded right away:
+    pressing it again while the next page is still queued is ignored too.
+    """
+    if not update.callback_query or OFFSET_DIVIDER not in arg:
+        return False
+    message_id = update.callback_query.message.message_id
+    if message_id == user_data.get('navigated_from'):
+        return True
+    if 'last_messages' in user_data and message_id not in user_data['last_messages']:
+        return True
+    user_data['navigated_from'] = message_id
+    return False
+
+
 def view_pack(bot, update, arg: str=None, user_data=None):
     if not arg:
         edit_or_send(bot, update, "Select the pack to view", create_select_sticker_menu(update.effective_user.id, VIEW_PACK_CHAR))
@@ -21,6 +53,10 @@ def view_pack(bot, update, arg: str=None, user_data=None):
 
     chat_id = update.effective_chat.id
 
+    if is_stale_navigation(update, arg, user_data):
+        logging.debug("Ignoring stale navigation: %s", arg)
+        return
+
     # Split sticker and offset
     # In theory the divider should not be part of the name so there's no
     # confusion when splitting the command
@@ -35,9 +71,9 @@ def view_pack(bot, update, arg: str=None, user_data=None):
         except ValueError:
             offset = 0
 
-    entries, more = get_pack_entries(bot, update.effective_user.id, name, offset * MAX_VIEW_RESULTS, MAX_VIEW_RESULTS)
+    entries, more = get_pack_entries(bot, update.effective_user.id, [name], offset * MAX_VIEW_RESULTS, MAX_VIEW_RESULTS)
 
-    logging.debug("Entries for %s: %s", name, entries)
+    logging.debug("Entries for %s: %d, more: %s", name, len(entries), more)
 
     if entries is None:
         edit_or_send(bot, update, "Cannot find pack")
@@ -62,38 +98,56 @@ def view_pack(bot, update, arg: str=None, user_data=None):
 
     more_markup = InlineKeyboardMarkup(buttons)
 
-    if 'last_messages' in user_data:
-        message_ids = user_data.pop('last_messages')
-        for id in message_ids:
-            bot.delete_message(chat_id=chat_id, message_id=id)
-
-    if entries:
-        message_ids = []
-        for entry, has_more in lookahead(entries):
-            entry_type, content = entry
-            try:
-                if entry_type == EntryType.STICKER:
-                    message = bot.send_sticker(chat_id=chat_id, sticker=content, timeout=3000, reply_markup=None if has_more else more_markup)
-                elif entry_type == EntryType.GIF:
-                    message = bot.send_document(chat_id=chat_id, document=content, reply_markup=None if has_more else more_markup)
-                else:
-                    logging.warning('Unsupported type: %s', entry_type)
-                    continue
-            except BadRequest as req:
-                if req.message != "Document_invalid":
-                    raise
-                # Thanks to telegram api every file_id is unique from bot to bot
-                bot.send_message(
-                    update.effective_user.id,
-                    "Error with file_id, please contact the /author"
-                )
-                logging.exception("Error during view operation")
-                return
-
-            message_ids.append(message.message_id)
-        user_data['last_messages'] = message_ids
-    else:
+    # The old page gets deleted while the new one is being sent
+    delete_messages(bot, chat_id, user_data.pop('last_messages', []))
+    send_page(bot, update, chat_id, entries, more_markup, user_data)
+
+
+def send_page(bot, update, chat_id, entries, more_markup, user_data):
+    """Queues the entries in order, the last one carrying the navigation keyboard
+
+    The handler doesn't wait for the page (and for the flood control), its messages are added to
+    user_data['last_messages'] once they're all sent.
+    """
+    if not entries:
         edit_or_send(bot, update, text="No sticker found", reply_markup=more_markup)
+        return
+
+    sends = []
+    for entry, has_more in lookahead(entries):
+        entry_type, content = entry
+        if entry_type == EntryType.STICKER:
+            sends.append(bot.submit('send_sticker', chat_id=chat_id, sticker=content, timeout=3000,
+                                    reply_markup=None if has_more else more_markup))
+        elif entry_type == EntryType.GIF:
+            sends.append(bot.submit('send_document', chat_id=chat_id, document=content,
+                                    reply_markup=None if has_more else more_markup))
+        else:
+            logging.warning('Unsupported type: %s', entry_type)
+
+    failed = []
+
+    def on_sent(send):
+        error = None if send.cancelled() else send.exception()
+        if error is None:
+            return
+        logging.error("Error during view operation", exc_info=error)
+        if isinstance(error, BadRequest) and error.message == "Document_invalid" and not failed:
+            # The rest of the page is not sent
+            failed.append(send)
+            for other in sends:
+                other.cancel()
+            # Thanks to telegram api every file_id is unique from bot to bot
+            bot.submit('send_message', update.effective_user.id, "Error with file_id, please contact the /author")
+
+    def on_page_sent(sends):
+        # Added, another page might have been sent meanwhile (ex. /view twice) and both have to be deleted
+        user_data.setdefault('last_messages', []).extend(send.result().message_id for send in sends
+                                                         if not send.cancelled() and send.exception() is None)
+
+    for send in sends:
+        send.add_done_callback(on_sent)
+    when_all_done(sends, on_page_sent)
 
 
 def on_view_command(bot, update, user_data=None):
@@ -0,0 +1,318 @@
+"""
+Flood-control aware scheduler for the outgoing Telegram API calls
+
+Every call is queued in a priority lane and executed only when both the global and the per-chat
+token buckets allow it. The calls of the same chat run one at a time and in order, so the messages
+are shown in the order they were sent, and a RetryAfter (429) pauses the call (and its chat) for
+the requested time before retrying it.
+
+The handlers run on the dispatcher thread, so a call they wait for gives up with RetryAfter when it
+can't start within OUTBOUND_MAX_WAIT seconds. Bulk sends are queued with ScheduledBot.submit instead,
+which returns a Future and doesn't wait at all.
+"""
+import itertools
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from telegram import Bot
+from telegram.error import RetryAfter
+from telegram.utils.request import Request
+
+import metrics
+
+# Priority lanes, lower goes first
+PRIORITY_INTERACTIVE = 0  # Inline answers and callback acks, the user is waiting for them
+PRIORITY_NORMAL = 1       # Text replies and menu edits
+PRIORITY_BULK = 2         # Pages of media and their cleanup
+
+OUTBOUND_GLOBAL_RATE = float(os.environ.get('OUTBOUND_GLOBAL_RATE', default=30))
+OUTBOUND_CHAT_RATE = float(os.environ.get('OUTBOUND_CHAT_RATE', default=1))
+# A whole /view page can be sent in a single burst
+OUTBOUND_CHAT_BURST = int(os.environ.get('OUTBOUND_CHAT_BURST', default=25))
+OUTBOUND_WORKERS = int(os.environ.get('OUTBOUND_WORKERS', default=8))
+# Seconds a call the caller waits for can stay queued (ex. because of the flood control) before failing
+OUTBOUND_MAX_WAIT = float(os.environ.get('OUTBOUND_MAX_WAIT', default=3))
+
+
+class TokenBucket:
+    """Allows ``rate`` operations per second with bursts of up to ``capacity`` operations"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+
+    def delay(self, now):
+        """Seconds to wait before a token is available (0 if there's one now)"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class OutboundRequest:
+    def __init__(self, seq, priority, chat_id, global_limited, func, args, kwargs, max_wait=None):
+        self.seq = seq
+        self.priority = priority
+        self.chat_id = chat_id
+        self.global_limited = global_limited
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.not_before = 0
+        self.queued_at = time.monotonic()
+        self.deadline = None if max_wait is None else self.queued_at + max_wait
+        self.started = False
+        self.future = Future()
+
+    @property
+    def order(self):
+        return self.priority, self.seq
+
+
+class OutboundScheduler:
+    def __init__(self, global_rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE,
+                 chat_burst=OUTBOUND_CHAT_BURST, workers=OUTBOUND_WORKERS):
+        self.logger = logging.getLogger(__name__)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+
+        self.global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+        self.chat_buckets = {}
+
+        self.chat_queues = {}     # chat_id -> deque of requests, run one at a time
+        self.busy_chats = set()
+        self.free_requests = []   # Requests not bound to a chat, run concurrently
+        self.seq = itertools.count()
+        self.last_prune = time.monotonic()
+
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='outbound')
+        self.thread = threading.Thread(target=self._run, name='outbound_scheduler', daemon=True)
+        self.thread.start()
+
+    def submit(self, priority, chat_id, global_limited, func, args=(), kwargs=None, max_wait=None):
+        """Schedules func(*args, **kwargs), returns the Future of its result
+
+        If it can't start within max_wait seconds the Future fails with RetryAfter.
+        A cancelled Future is skipped.
+        """
+        kwargs = kwargs or {}
+        request = OutboundRequest(next(self.seq), priority, chat_id, global_limited, func, args, kwargs, max_wait)
+        with self.condition:
+            if chat_id is None:
+                self.free_requests.append(request)
+            else:
+                self.chat_queues.setdefault(chat_id, deque()).append(request)
+            self.condition.notify()
+        return request.future
+
+    def call(self, priority, chat_id, global_limited, func, args=(), kwargs=None, max_wait=OUTBOUND_MAX_WAIT):
+        """Schedules func(*args, **kwargs) and waits for its result"""
+        return self.submit(priority, chat_id, global_limited, func, args, kwargs, max_wait).result()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _candidates(self):
+        for request in self.free_requests:
+            yield request
+        for chat_id, queue in self.chat_queues.items():
+            if chat_id not in self.busy_chats:
+                yield queue[0]
+
+    def _delay(self, request, now):
+        delay = request.not_before - now
+        if request.global_limited:
+            delay = max(delay, self.global_bucket.delay(now))
+        if request.chat_id is not None:
+            delay = max(delay, self._chat_bucket(request.chat_id).delay(now))
+        return max(delay, 0)
+
+    def _next_request(self):
+        """Returns the ready request with the highest priority or the seconds to wait for one"""
+        now = time.monotonic()
+        best, wait = None, None
+        for request in sorted(self._candidates(), key=lambda r: r.order):
+            delay = self._delay(request, now)
+            if delay <= 0:
+                best = request
+                break
+            wait = delay if wait is None else min(wait, delay)
+        return best, wait
+
+    def _expire(self, now):
+        """Fails the queued requests past their deadline, returns the seconds until the next deadline"""
+        expired = [request for request in self.free_requests if request.deadline is not None and request.deadline <= now]
+        for request in expired:
+            self.free_requests.remove(request)
+        for chat_id, queue in list(self.chat_queues.items()):
+            # The head of a busy chat is running
+            waiting = list(queue)[1:] if chat_id in self.busy_chats else list(queue)
+            chat_expired = [request for request in waiting if request.deadline is not None and request.deadline <= now]
+            if not chat_expired:
+                continue
+            for request in chat_expired:
+                queue.remove(request)
+            if not queue:
+                del self.chat_queues[chat_id]
+            expired += chat_expired
+
+        for request in expired:
+            delay = self._delay(request, now)
+            self.logger.debug("Outbound call waited too long (chat %s)", request.chat_id)
+            request.future.set_exception(RetryAfter(max(1, math.ceil(delay))))
+
+        deadlines = [request.deadline for request in self._queued() if request.deadline is not None]
+        return min(deadlines) - now if deadlines else None
+
+    def _queued(self):
+        yield from self.free_requests
+        for queue in self.chat_queues.values():
+            yield from queue
+
+    def _prune_buckets(self, now):
+        """Forgets the buckets of the idle chats, a new one would be full anyway"""
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            if chat_id not in self.chat_queues and bucket.delay(now) == 0 and bucket.tokens >= bucket.capacity:
+                del self.chat_buckets[chat_id]
+        self.last_prune = now
+
+    def _run(self):
+        while True:
+            with self.condition:
+                now = time.monotonic()
+                if now - self.last_prune > 60:
+                    self._prune_buckets(now)
+
+                next_deadline = self._expire(now)
+                request, wait = self._next_request()
+                if request is None:
+                    if next_deadline is not None:
+                        wait = next_deadline if wait is None else min(wait, next_deadline)
+                    self.condition.wait(wait)
+                    continue
+
+                if request.global_limited:
+                    self.global_bucket.take()
+                if request.chat_id is None:
+                    self.free_requests.remove(request)
+                else:
+                    self._chat_bucket(request.chat_id).take()
+                    self.busy_chats.add(request.chat_id)
+            self.executor.submit(self._execute, request)
+
+    def _execute(self, request):
+        metrics.outbound_wait_seconds.observe(time.monotonic() - request.queued_at, request.priority)
+        retry_after = None
+        if not request.started and not request.future.set_running_or_notify_cancel():
+            # Cancelled while queued
+            pass
+        else:
+            request.started = True
+            try:
+                result = request.func(*request.args, **request.kwargs)
+            except RetryAfter as e:
+                if request.deadline is not None and time.monotonic() + e.retry_after > request.deadline:
+                    request.future.set_exception(e)
+                else:
+                    retry_after = e.retry_after
+            except BaseException as e:
+                request.future.set_exception(e)
+            else:
+                request.future.set_result(result)
+
+        with self.condition:
+            if retry_after is not None:
+                self.logger.warning("Flood control exceeded (chat %s), retrying in %s seconds",
+                                    request.chat_id, retry_after)
+                request.not_before = time.monotonic() + retry_after
+                request.queued_at = time.monotonic()
+                if request.chat_id is None:
+                    self.free_requests.append(request)
+            elif request.chat_id is not None:
+                queue = self.chat_queues[request.chat_id]
+                queue.popleft()
+                if not queue:
+                    del self.chat_queues[request.chat_id]
+            self.busy_chats.discard(request.chat_id)
+            self.condition.notify()
+
+
+class TimedRequest(Request):
+    """Request that records the latency of every API call by method"""
+
+    def _timed(self, method, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            metrics.api_errors.inc(method)
+            raise
+        finally:
+            metrics.api_seconds.observe(time.perf_counter() - start, method)
+
+    def get(self, url, timeout=None):
+        return self._timed(url.rsplit('/', 1)[-1], super().get, url, timeout=timeout)
+
+    def post(self, url, data, timeout=None):
+        return self._timed(url.rsplit('/', 1)[-1], super().post, url, data, timeout=timeout)
+
+    def retrieve(self, url, timeout=None):
+        return self._timed('download', super().retrieve, url, timeout=timeout)
+
+
+# Method name -> (priority, per_chat, global_limited)
+SCHEDULES = {}
+
+
+def _scheduled(method_name, priority, per_chat=True, global_limited=True):
+    SCHEDULES[method_name] = (priority, per_chat, global_limited)
+
+    def method(self, *args, **kwargs):
+        return self._schedule(method_name, args, kwargs, OUTBOUND_MAX_WAIT).result()
+
+    method.__name__ = method_name
+    return method
+
+
+class ScheduledBot(Bot):
+    """Bot whose outgoing messages go through an OutboundScheduler"""
+
+    def __init__(self, token, scheduler, **kwargs):
+        super().__init__(token, **kwargs)
+        self.scheduler = scheduler
+
+    def _schedule(self, method_name, args, kwargs, max_wait):
+        priority, per_chat, global_limited = SCHEDULES[method_name]
+        chat_id = kwargs.get('chat_id', args[0] if args else None) if per_chat else None
+        func = getattr(super(), method_name)
+        return self.scheduler.submit(priority, chat_id, global_limited, func, args, kwargs, max_wait)
+
+    def submit(self, method_name, *args, **kwargs):
+        """Queues a call of a scheduled method without waiting for it, returns its Future"""
+        return self._schedule(method_name, args, kwargs, None)
+
+    answer_inline_query = _scheduled('answer_inline_query', PRIORITY_INTERACTIVE, per_chat=False, global_limited=False)
+    answer_callback_query = _scheduled('answer_callback_query', PRIORITY_INTERACTIVE, per_chat=False,
+                                       global_limited=False)
+
+    send_message = _scheduled('send_message', PRIORITY_NORMAL)
+    edit_message_text = _scheduled('edit_message_text', PRIORITY_NORMAL)
+    edit_message_reply_markup = _scheduled('edit_message_reply_markup', PRIORITY_NORMAL)
+
+    send_sticker = _scheduled('send_sticker', PRIORITY_BULK)
+    send_document = _scheduled('send_document', PRIORITY_BULK)
+    # Deletions don't show anything, they don't need to keep the chat order
+    delete_message = _scheduled('delete_message', PRIORITY_BULK, per_chat=False)
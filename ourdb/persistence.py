@@ -0,0 +1,205 @@
+"""
+Stores the conversation states and the user_data in the bot database
+
+Nothing is loaded at startup: the user_data of a user and the states of a conversation are read the first
+time they're accessed, so every process only keeps the data of the users it served.
+Nothing is written while handling an update: the users that sent an update are only marked and then
+flush(), called periodically by a job and when the bot stops, writes together their user_data and the
+conversation states that changed since the last flush.
+A user_data whose serialization didn't change since the last flush is not written again.
+"""
+import json
+import logging
+import os
+import pickle
+import threading
+import zlib
+from functools import wraps
+
+from telegram import Update
+
+# Seconds between two writes of the changed conversation data
+PERSISTENCE_FLUSH_INTERVAL = int(os.environ.get('PERSISTENCE_FLUSH_INTERVAL', default=30))
+
+
+def dump_user_data(data):
+    return zlib.compress(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def load_user_data(blob):
+    return pickle.loads(zlib.decompress(blob))
+
+
+def _snapshot(conversations):
+    """Copies the states of a ConversationHandler, keeping only the ones that can be stored"""
+    while True:
+        try:
+            items = list(conversations.items())
+            break
+        except RuntimeError:
+            # Changed by the dispatcher while being copied
+            continue
+    states = {}
+    for key, state in items:
+        try:
+            states[json.dumps(list(key))] = json.dumps(state)
+        except TypeError:
+            # Ex. a state waiting for a run_async promise
+            continue
+    return states
+
+
+class LazyUserData(dict):
+    """dispatcher.user_data, loading the user_data of a user with load(user_id) on first access"""
+
+    def __init__(self, load):
+        super().__init__()
+        self.load = load
+        self._lock = threading.Lock()
+
+    def __missing__(self, user_id):
+        with self._lock:
+            # Loaded by another thread meanwhile
+            if user_id not in self:
+                self[user_id] = self.load(user_id)
+            return dict.__getitem__(self, user_id)
+
+
+class LazyConversations(dict):
+    """ConversationHandler.conversations, loading the states of a key with load(key) on first access
+
+    load() stores the states itself and marks the key as loaded, see DbPersistence._load_conversation
+    """
+
+    def __init__(self, load):
+        super().__init__()
+        self.load = load
+        self.loaded = set()
+
+    def get(self, key, default=None):
+        if key not in self.loaded:
+            self.load(key)
+        return super().get(key, default)
+
+    def __contains__(self, key):
+        if key not in self.loaded:
+            self.load(key)
+        return super().__contains__(key)
+
+
+class DbPersistence:
+    def __init__(self, storage):
+        self.logger = logging.getLogger(__name__)
+        self.storage = storage
+
+        self.user_data = None
+        self.conversation_handlers = {}
+
+        self._lock = threading.Lock()
+        self._saved_user_data = {}    # user_id -> last blob written
+        self._saved_states = {}       # conversation name -> {key: state} last written
+        self._dirty_users = set()
+
+    def attach(self, dispatcher, conversation_handlers):
+        """Makes the dispatcher and the ConversationHandlers (a dict name -> handler) load the saved data"""
+        self.user_data = dispatcher.user_data = LazyUserData(self._load_user_data)
+
+        self.conversation_handlers = conversation_handlers
+        for name, handler in conversation_handlers.items():
+            handler.conversations = LazyConversations(self._load_conversation)
+            self._saved_states[name] = {}
+
+        dispatcher.process_update = self.track_updates(dispatcher.process_update)
+
+    def _load_user_data(self, user_id):
+        with self.storage.session_scope() as session:
+            blob = self.storage.load_user_data(session, user_id)
+        if blob is None:
+            return {}
+        self._saved_user_data[user_id] = blob
+        try:
+            return load_user_data(blob)
+        except Exception:
+            # Ex. a class that has been renamed, the user will just start over
+            self.logger.exception("Cannot load the user_data of %s", user_id)
+            return {}
+
+    def _load_conversation(self, key):
+        """Loads the states of the key in every ConversationHandler at once"""
+        stored_key = json.dumps(list(key))
+        with self.storage.session_scope() as session:
+            states = self.storage.load_conversation_states(session, list(self.conversation_handlers), stored_key)
+        with self._lock:
+            for name, handler in self.conversation_handlers.items():
+                if name in states:
+                    handler.conversations[key] = json.loads(states[name])
+                    self._saved_states[name][stored_key] = states[name]
+                handler.conversations.loaded.add(key)
+
+    def track_updates(self, process_update):
+        """Wraps Dispatcher.process_update to mark the users whose user_data might have changed"""
+        @wraps(process_update)
+        def wrapped(update):
+            try:
+                return process_update(update)
+            finally:
+                if isinstance(update, Update) and update.effective_user is not None:
+                    self.update_user_data(update.effective_user.id)
+        return wrapped
+
+    def update_user_data(self, user_id):
+        with self._lock:
+            self._dirty_users.add(user_id)
+
+    def flush(self):
+        with self._lock:
+            dirty_users, self._dirty_users = self._dirty_users, set()
+
+        blobs = {}
+        for user_id in dirty_users:
+            if user_id not in self.user_data:
+                continue
+            try:
+                blob = dump_user_data(self.user_data[user_id])
+            except RuntimeError:
+                # Changed by a handler while being serialized, retry on the next flush
+                self.update_user_data(user_id)
+                continue
+            except Exception:
+                self.logger.exception("Cannot save the user_data of %s", user_id)
+                continue
+            if blob != self._saved_user_data.get(user_id):
+                blobs[user_id] = blob
+
+        current_states = {}
+        changed_states = {}
+        for name, handler in self.conversation_handlers.items():
+            with self._lock:
+                # A state loaded meanwhile would look like an ended conversation
+                current = current_states[name] = _snapshot(handler.conversations)
+                saved = dict(self._saved_states.get(name, {}))
+            changed = {key: state for key, state in current.items() if saved.get(key) != state}
+            changed.update({key: None for key in saved if key not in current})
+            if changed:
+                changed_states[name] = changed
+
+        if not blobs and not changed_states:
+            return
+
+        try:
+            with self.storage.session_scope() as session:
+                self.storage.save_user_data(session, blobs)
+                for name, states in changed_states.items():
+                    self.storage.save_conversation_states(session, name, states)
+        except Exception:
+            # Try again on the next flush
+            with self._lock:
+                self._dirty_users.update(dirty_users)
+            raise
+        self._saved_user_data.update(blobs)
+        self._saved_states.update(current_states)
+        self.logger.debug("Saved %d user_data and %d conversation states",
+                          len(blobs), sum(len(states) for states in changed_states.values()))
+
+    def flush_job(self, bot, job):
+        self.flush()
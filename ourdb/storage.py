@@ -1,15 +1,34 @@
 import logging
 import os
+import threading
+import time
 from contextlib import contextmanager
+from functools import wraps
 from enum import Enum
 
-from sqlalchemy import Column, Integer, String, PrimaryKeyConstraint
-from sqlalchemy import create_engine
+from sqlalchemy import Column, Integer, String, LargeBinary, PrimaryKeyConstraint, Index, ForeignKey, func
+from sqlalchemy import create_engine, inspect, select, delete, text, case
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from eventlog import EventLogger
+
 DB_URL = os.environ['DATABASE_URL']
 
+# Connection pool tuning, the size and overflow are ignored by SQLite
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', default=5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', default=10))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', default=30))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', default='True') == 'True'
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', default=60 * 30))
+
+# Rows written by every multi-row INSERT when importing (keep it under 333 on SQLite older than 3.32)
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', default=300))
+# Rows fetched at a time from the server-side cursor when exporting
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', default=1000))
+
 Base = declarative_base()
 
 
@@ -24,112 +43,590 @@ class EntryType(Enum):
         return any(value == item.value for item in cls)
 
 
-# TODO: divide entries and packs
-class PackEntry(Base):
-    __tablename__ = 'pack_entries'
+SCHEMA_VERSION = 4
+# Table of the schema before version 1, migrate.py removes it once the new tables caught up with it
+LEGACY_TABLE = 'pack_entries'
+
+
+class OutdatedSchemaError(Exception):
+    pass
+
+
+class Pack(Base):
+    __tablename__ = 'packs'
     __table_args__ = (
-        PrimaryKeyConstraint("owner_id", "pack_name", "entry_type", "entry_data"),
+        # Covers the pack listing and existence checks of a user
+        Index('ix_packs_owner_name', 'owner_id', 'name', unique=True),
     )
 
+    id = Column(Integer, primary_key=True)
     owner_id = Column(Integer, nullable=False)
-    pack_name = Column(String(50), nullable=False)
+    name = Column(String(50), nullable=False)
+
+
+class Entry(Base):
+    __tablename__ = 'entries'
+    __table_args__ = (
+        PrimaryKeyConstraint("pack_id", "entry_type", "entry_data"),
+        # Used to find every mention of a sticker set (remove_every_pack_mention)
+        Index('ix_entries_type_data', 'entry_type', 'entry_data', 'pack_id'),
+    )
+
+    pack_id = Column(Integer, ForeignKey('packs.id', ondelete='CASCADE'), nullable=False)
     entry_type = Column(String(1), nullable=False)
     entry_data = Column(String(32), nullable=False)
 
 
-class DbStorage:
+class UserStats(Base):
+    """Per-user counters, kept up to date in the same transaction as the entries they count"""
+    __tablename__ = 'user_stats'
+
+    owner_id = Column(Integer, primary_key=True, autoincrement=False)
+    entry_count = Column(Integer, nullable=False)
+
+
+class UserDataBlob(Base):
+    """The bot's user_data of a user, compressed (see persistence.py)"""
+    __tablename__ = 'user_data'
+
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    data = Column(LargeBinary, nullable=False)
+
+
+class ConversationState(Base):
+    __tablename__ = 'conversation_states'
+
+    name = Column(String(32), primary_key=True)
+    key = Column(String(64), primary_key=True)
+    state = Column(String(32), nullable=False)
+
+
+class Meta(Base):
+    __tablename__ = 'meta'
+
+    key = Column(String(32), primary_key=True)
+    value = Column(String(200), nullable=False)
+
+
+# Toggles an entry in a single statement, creating the pack if needed.
+# Returns (removed, inserted), both false only if the pack has been created concurrently
+POSTGRES_TOGGLE_ENTRY = text("""
+WITH existing AS (
+    SELECT id FROM packs WHERE owner_id = :owner_id AND name = :name
+), created AS (
+    INSERT INTO packs (owner_id, name)
+    SELECT CAST(:owner_id AS INTEGER), CAST(:name AS VARCHAR) WHERE NOT EXISTS (SELECT 1 FROM existing)
+    ON CONFLICT DO NOTHING RETURNING id
+), pack AS (
+    SELECT id FROM existing UNION ALL SELECT id FROM created
+), removed AS (
+    DELETE FROM entries USING pack
+    WHERE entries.pack_id = pack.id AND entry_type = :entry_type AND entry_data = :entry_data
+    RETURNING 1
+), inserted AS (
+    INSERT INTO entries (pack_id, entry_type, entry_data)
+    SELECT id, CAST(:entry_type AS VARCHAR), CAST(:entry_data AS VARCHAR) FROM pack
+    WHERE NOT EXISTS (SELECT 1 FROM removed)
+    ON CONFLICT DO NOTHING RETURNING 1
+)
+SELECT EXISTS (SELECT 1 FROM removed), EXISTS (SELECT 1 FROM inserted)
+""")
+
+
+def escape_like(text, escape='\\'):
+    """Escapes the wildcards of text, to be used in like(..., escape=escape)"""
+    return text.replace(escape, escape * 2).replace('%', escape + '%').replace('_', escape + '_')
+
+
+def engine_args(db_url):
+    """Connection pool arguments for create_engine (or create_async_engine)"""
+    args = dict(pool_pre_ping=DB_POOL_PRE_PING, pool_recycle=DB_POOL_RECYCLE)
+    if not db_url.startswith('sqlite'):
+        args.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+    return args
+
+
+class StorageQueries:
+    """
+    Every storage operation, written against a synchronous session.
+
+    DbStorage runs them directly while AsyncDbStorage runs them through ``AsyncSession.run_sync``,
+    so both storages always issue the same queries.
+    """
+
     def __init__(self):
-        self.logger = logging.getLogger()
-        self.engine = create_engine(DB_URL)
-        self.Session = sessionmaker(bind=self.engine)
+        self.logger = logging.getLogger(__name__)
+        self.events = EventLogger(__name__)
 
-    def init(self):
-        Base.metadata.create_all(self.engine)
+    def init_schema(self, session, upgrading=False):
+        """Creates the tables of a new database
 
-    @contextmanager
-    def session_scope(self):
-        """Provide a transactional scope around a series of operations."""
-        session = self.Session()
-        try:
-            yield session
-            session.commit()
-        except:
-            session.rollback()
-            raise
-        finally:
-            session.close()
+        Raises OutdatedSchemaError if the database needs migrate.py first, unless upgrading (migrate.py itself)
+        """
+        connection = session.connection()
+        version = self.get_schema_version(session) if inspect(connection).has_table(Meta.__tablename__) else None
+        legacy = inspect(connection).has_table(LEGACY_TABLE)
+        if version == SCHEMA_VERSION and not legacy:
+            # Up to date, create_all would only reflect every table again
+            return
 
-    def get_packs(self, session, user_id):
-        self.logger.debug("Get Pack: %s" % user_id)
+        if version is None and not legacy:
+            # Brand new database, nothing to migrate
+            Base.metadata.create_all(connection)
+            self.set_schema_version(session, SCHEMA_VERSION)
+            return
 
-        res = session.query(PackEntry.pack_name).filter(PackEntry.owner_id == user_id).distinct().all()
+        # Serving an outdated database would show the users an empty copy of their packs,
+        # and the catch-up of migrate.py would then drop whatever they wrote to it
+        if not upgrading and (version is None or version < SCHEMA_VERSION):
+            raise OutdatedSchemaError("Database schema version is %s but %s is required, run migrate.py"
+                                      % (version, SCHEMA_VERSION))
+        if not upgrading and legacy:
+            raise OutdatedSchemaError("The %s table has not been caught up with yet, stop the old bot and run "
+                                      "migrate.py --redo 1" % LEGACY_TABLE)
+        if version is not None and version > SCHEMA_VERSION:
+            self.logger.warning("Database schema version is %s, newer than %s", version, SCHEMA_VERSION)
+        Base.metadata.create_all(connection)
 
-        self.logger.debug("Get Pack Response: " + str(res))
+    def get_meta(self, session, key):
+        meta = session.get(Meta, key)
+        return None if meta is None else meta.value
+
+    def set_meta(self, session, key, value):
+        """Stores the value of key, None removes it"""
+        if value is None:
+            session.execute(delete(Meta).where(Meta.key == key))
+        else:
+            session.merge(Meta(key=key, value=value))
+
+    def get_schema_version(self, session):
+        version = self.get_meta(session, 'schema_version')
+        return None if version is None else int(version)
+
+    def set_schema_version(self, session, version):
+        self.set_meta(session, 'schema_version', str(version))
+
+    def _mark_changed(self, session, user_id):
+        session.info.setdefault('changed_users', set()).add(user_id)
+
+    def _get_pack_id(self, session, user_id, name):
+        res = session.query(Pack.id).filter(Pack.owner_id == user_id, Pack.name == name).first()
+        return None if res is None else res[0]
+
+    def _get_or_create_pack_id(self, session, user_id, name):
+        pack_id = self._get_pack_id(session, user_id, name)
+        if pack_id is None:
+            self._insert_ignore(session, Pack.__table__, [{'owner_id': user_id, 'name': name}])
+            pack_id = self._get_pack_id(session, user_id, name)
+        return pack_id
+
+    def _dialect_insert(self, session):
+        """Returns the insert construct supporting ON CONFLICT for the current database, if any"""
+        return {
+            'postgresql': postgresql.insert,
+            'sqlite': sqlite.insert,
+        }.get(session.get_bind().dialect.name)
+
+    def _insert_ignore(self, session, table, rows):
+        """Inserts the rows skipping the ones that would violate a unique constraint, returns the inserted count"""
+        insert = self._dialect_insert(session)
+        if insert is not None:
+            return session.execute(insert(table).values(rows).on_conflict_do_nothing()).rowcount
+
+        inserted = 0
+        for row in rows:
+            try:
+                with session.begin_nested():
+                    session.execute(table.insert().values(row))
+                inserted += 1
+            except IntegrityError:
+                pass
+        return inserted
+
+    def _user_pack_ids(self, user_id):
+        return select(Pack.id).where(Pack.owner_id == user_id)
+
+    def get_packs(self, session, user_id):
+        res = session.query(Pack.name).filter(Pack.owner_id == user_id).order_by(Pack.name).all()
+
+        self.events.debug('get_packs', sampled=True, user_id=user_id, packs=res)
         return [entry[0] for entry in res]
 
     def has_pack(self, session, user_id, name):
-        return session.query(PackEntry).filter(PackEntry.owner_id == user_id, PackEntry.pack_name == name).count() > 0
+        return self._get_pack_id(session, user_id, name) is not None
 
     def remove_pack(self, session, user_id, name):
-        self.logger.debug("Remove Pack: %s, pack: %s" % (user_id, name))
+        self.events.debug('remove_pack', user_id=user_id, pack=name)
+        self._mark_changed(session, user_id)
 
-        return session.query(PackEntry)\
-            .filter(PackEntry.owner_id == user_id, PackEntry.pack_name == name)\
-            .delete() > 0
+        pack_id = self._get_pack_id(session, user_id, name)
+        if pack_id is None:
+            return False
+        removed = session.query(Entry).filter(Entry.pack_id == pack_id).delete(synchronize_session=False)
+        session.query(Pack).filter(Pack.id == pack_id).delete(synchronize_session=False)
+        self._add_to_entry_count(session, user_id, -removed)
+        return True
 
     def get_entries(self, session, user_id, pack_name, similar):
-        self.logger.info("Get Stickers: %s, pack: %s" % (user_id, pack_name))
-
-        second_filter = PackEntry.pack_name.like(pack_name) if similar else PackEntry.pack_name == pack_name
-        res = session.query(PackEntry).filter(PackEntry.owner_id == user_id, second_filter).all()
+        second_filter = Pack.name.like(pack_name) if similar else Pack.name == pack_name
+        res = session.query(Entry.entry_type, Entry.entry_data).join(Pack, Entry.pack_id == Pack.id)\
+            .filter(Pack.owner_id == user_id, second_filter)\
+            .order_by(Pack.name, Entry.entry_type, Entry.entry_data).all()
 
-        self.logger.info('Get Stickers response: ' + str([entry.entry_type + ", " + entry.entry_data for entry in res]))
+        self.events.debug('get_entries', sampled=True, user_id=user_id, pack=pack_name, similar=similar, entries=res)
         if not res: return []
         # Unpack entries
-        return [(entry.entry_type, entry.entry_data) for entry in res]
+        return [(entry_type, entry_data) for entry_type, entry_data in res]
+
+    def search_packs(self, session, user_id, query, limit):
+        """Returns the names of the packs containing query: the exact match, then the prefixes, then the rest
+
+        Only the user's rows of ix_packs_owner_name are read, so the substring search stays cheap
+        """
+        pattern = escape_like(query)
+        rank = case((Pack.name == query, 0), (Pack.name.like(pattern + '%', escape='\\'), 1), else_=2)
+        res = session.query(Pack.name)\
+            .filter(Pack.owner_id == user_id, Pack.name.like('%' + pattern + '%', escape='\\'))\
+            .order_by(rank, func.length(Pack.name), Pack.name)\
+            .limit(limit)
+        return [name for name, in res]
+
+    def all_entries_query(self, user_id, batch_size=EXPORT_BATCH_SIZE):
+        """Every (pack_name, entry_type, entry_data) of the user ordered by pack, streamed batch_size rows at a time"""
+        return select(Pack.name, Entry.entry_type, Entry.entry_data)\
+            .select_from(Entry).join(Pack, Entry.pack_id == Pack.id)\
+            .where(Pack.owner_id == user_id)\
+            .order_by(Pack.name, Entry.entry_type, Entry.entry_data)\
+            .execution_options(yield_per=batch_size)
+
+    def iter_all_entries(self, session, user_id, batch_size=EXPORT_BATCH_SIZE):
+        """Yields every entry of the user (see all_entries_query) without loading them all in memory"""
+        for pack_name, entry_type, entry_data in session.execute(self.all_entries_query(user_id, batch_size)):
+            yield pack_name, entry_type, entry_data
+
+    def get_entry_layout(self, session, user_id, pack_names):
+        """Describes how the packs expand, without loading their plain entries
+
+        Returns a list of (pack_name, sticker_set_names, plain_entry_count) in the order of pack_names
+        (the packs without entries are left out), every pack expands to its sticker sets (in order)
+        followed by its plain entries
+        """
+        sets = session.query(Pack.name, Entry.entry_data)\
+            .select_from(Entry).join(Pack, Entry.pack_id == Pack.id)\
+            .filter(Pack.owner_id == user_id, Pack.name.in_(pack_names), Entry.entry_type == EntryType.PACK.value)\
+            .order_by(Pack.name, Entry.entry_data)
+        pack_sets = {}
+        for name, set_name in sets:
+            pack_sets.setdefault(name, []).append(set_name)
+
+        counts = dict(session.query(Pack.name, func.count())
+                      .select_from(Entry).join(Pack, Entry.pack_id == Pack.id)
+                      .filter(Pack.owner_id == user_id, Pack.name.in_(pack_names),
+                              Entry.entry_type != EntryType.PACK.value)
+                      .group_by(Pack.name))
+
+        return [(name, pack_sets.get(name, []), counts.get(name, 0)) for name in pack_names
+                if name in pack_sets or name in counts]
+
+    def get_plain_entries(self, session, user_id, pack_name, offset, limit):
+        """Returns a page of the entries that aren't sticker sets, in a stable order"""
+        res = session.query(Entry.entry_type, Entry.entry_data).join(Pack, Entry.pack_id == Pack.id)\
+            .filter(Pack.owner_id == user_id, Pack.name == pack_name, Entry.entry_type != EntryType.PACK.value)\
+            .order_by(Entry.entry_type, Entry.entry_data)\
+            .offset(offset).limit(limit).all()
+        return [(entry_type, entry_data) for entry_type, entry_data in res]
+
+    def get_existing_entries(self, session, user_id, pack_names):
+        """Returns {pack_name: {(entry_type, entry_data), ...}} for the packs of the user among pack_names
+
+        The names of the packs that don't exist are left out
+        """
+        res = session.execute(
+            select(Pack.name, Entry.entry_type, Entry.entry_data)
+            .select_from(Pack).outerjoin(Entry, Entry.pack_id == Pack.id)
+            .where(Pack.owner_id == user_id, Pack.name.in_(pack_names))
+        )
+        existing = {}
+        for name, entry_type, entry_data in res:
+            entries = existing.setdefault(name, set())
+            if entry_type is not None:
+                entries.add((entry_type, entry_data))
+        return existing
 
     def has_entry(self, session, user_id, pack_name, entry_type, entry_data):
-        return session.query(PackEntry).filter(
-            PackEntry.owner_id == user_id,
-            PackEntry.pack_name == pack_name,
-            PackEntry.entry_type == entry_type.value,
-            PackEntry.entry_data == entry_data
+        return session.query(Entry).join(Pack, Entry.pack_id == Pack.id).filter(
+            Pack.owner_id == user_id,
+            Pack.name == pack_name,
+            Entry.entry_type == entry_type.value,
+            Entry.entry_data == entry_data
         ).count() > 0
 
     def add_entry(self, session, user_id, pack_name, entry_type, entry_data, only_remove=True):
-        self.logger.debug(
-            "Add Stickers: %s, pack: %s, type: %s, entry: %s" % (user_id, pack_name, entry_type, entry_data))
-
-        is_entry_present = self.has_entry(session, user_id, pack_name, entry_type, entry_data)
-
-        self.logger.debug('Add stickers result: ' + str(is_entry_present))
-        if is_entry_present:
-            # Sticker already present, removing
-            is_entry_present = session.query(PackEntry).filter(
-                PackEntry.owner_id == user_id,
-                PackEntry.pack_name == pack_name,
-                PackEntry.entry_type == entry_type.value,
-                PackEntry.entry_data == entry_data
-            ).delete()
-        elif not only_remove:
-            session.add(PackEntry(owner_id=user_id, pack_name=pack_name, entry_type=entry_type.value, entry_data=entry_data))
-            # Sticker not found, adding
-        return not is_entry_present
+        """Toggles the entry, returns False if it got removed or True if it got (or would have been) added"""
+        removed, inserted = False, False
+        if not only_remove and session.get_bind().dialect.name == 'postgresql':
+            removed, inserted = session.execute(POSTGRES_TOGGLE_ENTRY, {
+                'owner_id': user_id,
+                'name': pack_name,
+                'entry_type': entry_type.value,
+                'entry_data': entry_data,
+            }).one()
+
+        if not removed and not inserted:
+            # The first statement takes the write lock so the toggle can't race with itself
+            removed = session.execute(delete(Entry).where(
+                Entry.pack_id == select(Pack.id).where(Pack.owner_id == user_id, Pack.name == pack_name)
+                .scalar_subquery(),
+                Entry.entry_type == entry_type.value,
+                Entry.entry_data == entry_data
+            ).execution_options(synchronize_session=False)).rowcount > 0
+
+            if not removed and not only_remove:
+                # Sticker not found, adding
+                pack_id = self._get_or_create_pack_id(session, user_id, pack_name)
+                inserted = self._insert_ignore(session, Entry.__table__, [{
+                    'pack_id': pack_id,
+                    'entry_type': entry_type.value,
+                    'entry_data': entry_data,
+                }]) > 0
+
+        self.events.debug('add_entry', sampled=True, user_id=user_id, pack=pack_name, entry_type=entry_type.value,
+                          entry=entry_data, removed=removed, inserted=inserted)
+        if removed or inserted:
+            self._add_to_entry_count(session, user_id, -1 if removed else 1)
+        if removed or not only_remove:
+            self._mark_changed(session, user_id)
+        return not removed
 
     def remove_every_pack_mention(self, session, user_id, stickerpack_name):
-        self.logger.debug("Sticker pack deleted: user: %s, pack: %s" % (user_id, stickerpack_name))
+        self.events.debug('remove_every_pack_mention', user_id=user_id, sticker_set=stickerpack_name)
+        self._mark_changed(session, user_id)
+
+        removed = session.query(Entry).filter(
+            Entry.pack_id.in_(self._user_pack_ids(user_id)),
+            Entry.entry_type == EntryType.PACK.value,
+            Entry.entry_data == stickerpack_name
+        ).delete(synchronize_session=False)
+        self._add_to_entry_count(session, user_id, -removed)
 
-        session.query(PackEntry).filter(
-            PackEntry.owner_id == user_id,
-            PackEntry.entry_type == EntryType.PACK.value,
-            PackEntry.entry_data == stickerpack_name
-        ).delete()
+    def import_pack(self, session, user_id, pack_name, pack_entries, batch_size=IMPORT_BATCH_SIZE):
+        """Adds the entries to the pack (creating it if needed) skipping the ones already present"""
+        self._mark_changed(session, user_id)
+        pack_id = self._get_or_create_pack_id(session, user_id, pack_name)
+        rows = [{'pack_id': pack_id, 'entry_type': entry_type, 'entry_data': entry_data}
+                for entry_type, entry_data in pack_entries]
+        # Drop the duplicates inside the file itself before sending them
+        rows = list({(row['entry_type'], row['entry_data']): row for row in rows}.values())
 
-    def import_pack(self, session, user_id, pack_name, pack_entries):
-        for entry in pack_entries:
-            entry_type, entry_data = entry
-            if not self.has_entry(session, user_id, pack_name, EntryType(entry_type), entry_data):
-                session.add(PackEntry(owner_id=user_id, pack_name=pack_name, entry_type=entry_type, entry_data=entry_data))
+        inserted = 0
+        for i in range(0, len(rows), batch_size):
+            inserted += self._insert_ignore(session, Entry.__table__, rows[i:i + batch_size])
+        self._add_to_entry_count(session, user_id, inserted)
+        return inserted
+
+    def _add_to_entry_count(self, session, user_id, delta):
+        if not delta:
+            return
+        insert = self._dialect_insert(session)
+        if insert is not None:
+            stmt = insert(UserStats.__table__).values(owner_id=user_id, entry_count=delta)
+            session.execute(stmt.on_conflict_do_update(
+                index_elements=['owner_id'],
+                set_={'entry_count': UserStats.__table__.c.entry_count + stmt.excluded.entry_count}
+            ))
+            return
+
+        updated = session.query(UserStats).filter(UserStats.owner_id == user_id)\
+            .update({UserStats.entry_count: UserStats.entry_count + delta}, synchronize_session=False)
+        if not updated:
+            session.add(UserStats(owner_id=user_id, entry_count=delta))
+            session.flush()
 
     def count_total_entries(self, session, user_id):
-        return session.query(PackEntry).filter(PackEntry.owner_id == user_id).count()
+        res = session.query(UserStats.entry_count).filter(UserStats.owner_id == user_id).first()
+        return 0 if res is None else res[0]
+
+    def reconcile_entry_counts(self, session):
+        """Recomputes the entry counters that drifted from the real entry count, returns the repaired users"""
+        real_counts = dict(session.query(Pack.owner_id, func.count(Entry.pack_id))
+                           .select_from(Pack).outerjoin(Entry, Entry.pack_id == Pack.id)
+                           .group_by(Pack.owner_id))
+        stored_counts = dict(session.query(UserStats.owner_id, UserStats.entry_count))
+
+        drifted = [user_id for user_id in set(real_counts) | set(stored_counts)
+                   if real_counts.get(user_id, 0) != stored_counts.get(user_id, 0)]
+        for user_id in drifted:
+            # Counted again in the update itself so that concurrent changes can't be overwritten
+            real_count = select(func.count()).select_from(Entry)\
+                .where(Entry.pack_id.in_(self._user_pack_ids(user_id))).scalar_subquery()
+            updated = session.query(UserStats).filter(UserStats.owner_id == user_id)\
+                .update({UserStats.entry_count: real_count}, synchronize_session=False)
+            if not updated:
+                session.add(UserStats(owner_id=user_id, entry_count=real_counts[user_id]))
+        if drifted:
+            self.logger.warning("Repaired the entry counters of %d users", len(drifted))
+        return drifted
+
+    def _upsert(self, session, table, rows, index_elements):
+        """Inserts the rows, replacing the ones with the same index_elements"""
+        insert = self._dialect_insert(session)
+        if insert is None:
+            for row in rows:
+                session.execute(table.delete().where(*(table.c[column] == row[column] for column in index_elements)))
+                session.execute(table.insert().values(row))
+            return
+        stmt = insert(table).values(rows)
+        session.execute(stmt.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={column.name: stmt.excluded[column.name] for column in table.c if column.name not in index_elements}
+        ))
+
+    def load_user_data(self, session, user_id):
+        """Returns the saved user_data of the user, None if there is none"""
+        res = session.query(UserDataBlob.data).filter(UserDataBlob.user_id == user_id).first()
+        return None if res is None else res[0]
+
+    def save_user_data(self, session, blobs):
+        """Saves the serialized user_data of every user in the dict"""
+        if blobs:
+            rows = [{'user_id': user_id, 'data': data} for user_id, data in blobs.items()]
+            self._upsert(session, UserDataBlob.__table__, rows, ['user_id'])
+
+    def load_conversation_states(self, session, names, key):
+        """Returns {name: state} for the conversations among names that have a saved state for key"""
+        return dict(session.query(ConversationState.name, ConversationState.state)
+                    .filter(ConversationState.name.in_(names), ConversationState.key == key))
+
+    def save_conversation_states(self, session, name, states):
+        """Saves the conversation states in the dict, a None state ends the conversation"""
+        ended = [key for key, state in states.items() if state is None]
+        if ended:
+            session.query(ConversationState)\
+                .filter(ConversationState.name == name, ConversationState.key.in_(ended))\
+                .delete(synchronize_session=False)
+        rows = [{'name': name, 'key': key, 'state': state} for key, state in states.items() if state is not None]
+        if rows:
+            self._upsert(session, ConversationState.__table__, rows, ['name', 'key'])
+
+
+class DbStorage(StorageQueries):
+    def __init__(self, db_url=None):
+        super().__init__()
+        db_url = db_url or DB_URL
+        self.engine = create_engine(db_url, **engine_args(db_url))
+        self.Session = sessionmaker(bind=self.engine)
+        self.change_listeners = []
+
+        # Session shared by every storage call of the current update (see unit_of_work)
+        self._local = threading.local()
+
+        self._checkout_lock = threading.Lock()
+        self.checkout_count = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+
+    def init(self, upgrading=False):
+        with self.session_scope() as session:
+            self.init_schema(session, upgrading)
+
+    def add_change_listener(self, listener):
+        """Registers a function called with the user id whenever a transaction modifying their entries commits"""
+        self.change_listeners.append(listener)
+
+    def _notify_changes(self, session):
+        for user_id in session.info.pop('changed_users', ()):
+            for listener in self.change_listeners:
+                listener(user_id)
+
+    def _checkout(self, session):
+        # Check out the connection right away to measure how long the pool makes us wait
+        start = time.perf_counter()
+        session.connection()
+        wait = time.perf_counter() - start
+        with self._checkout_lock:
+            self.checkout_count += 1
+            self.checkout_wait_total += wait
+            self.checkout_wait_max = max(self.checkout_wait_max, wait)
+
+    def pool_stats(self):
+        with self._checkout_lock:
+            return {
+                'status': self.engine.pool.status(),
+                'checkouts': self.checkout_count,
+                'checkout_wait_total': self.checkout_wait_total,
+                'checkout_wait_max': self.checkout_wait_max,
+            }
+
+    @contextmanager
+    def _transaction(self, session):
+        self._checkout(session)
+        try:
+            yield session
+            session.commit()
+            self._notify_changes(session)
+        except:
+            session.rollback()
+            session.info.pop('changed_users', None)
+            raise
+
+    @contextmanager
+    def session_scope(self):
+        """Provide a transactional scope around a series of operations.
+
+        Inside a unit of work the scope reuses its session, nested scopes join the enclosing transaction.
+        """
+        unit = getattr(self._local, 'unit', None)
+        if unit is None:
+            session = self.Session()
+            try:
+                with self._transaction(session):
+                    yield session
+            finally:
+                session.close()
+            return
+
+        if unit['session'] is None:
+            unit['session'] = self.Session()
+        if unit['depth']:
+            unit['depth'] += 1
+            try:
+                yield unit['session']
+            finally:
+                unit['depth'] -= 1
+            return
+
+        unit['depth'] = 1
+        try:
+            with self._transaction(unit['session']) as session:
+                yield session
+        finally:
+            unit['depth'] = 0
+
+    @contextmanager
+    def unit_of_work(self):
+        """Shares one session between every session_scope opened by this thread
+
+        Every outermost scope is still its own transaction, committed on exit so that no connection is held
+        while the handler waits on the network. The unit itself never commits: python-telegram-bot swallows
+        the errors of the handlers, so it can't tell whether the update failed.
+        """
+        if getattr(self._local, 'unit', None) is not None:
+            yield
+            return
+
+        unit = self._local.unit = {'session': None, 'depth': 0}
+        try:
+            yield
+        finally:
+            self._local.unit = None
+            if unit['session'] is not None:
+                unit['session'].rollback()
+                unit['session'].close()
+
+    def bind_unit_of_work(self, func):
+        """Wraps func so that every storage call it makes shares a single unit of work"""
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            with self.unit_of_work():
+                return func(*args, **kwargs)
+        return wrapped
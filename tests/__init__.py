@@ -0,0 +1,28 @@
+"""
+Behaviour tests, run with: python3 -m unittest discover -s tests -t .
+
+The bot modules read their configuration at import time, the defaults below point them to a
+throwaway SQLite database.
+"""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_tmp = tempfile.mkdtemp(prefix='ourdb_tests')
+atexit.register(shutil.rmtree, _tmp, True)
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(_tmp, 'bot.db'))
+os.environ.setdefault('WEBHOOK', 'False')
+os.environ.setdefault('TOKEN', '123:test')
+os.environ.setdefault('ENTRY_LIMIT', '-1')
+os.environ.setdefault('METRICS_PORT', '0')
+sys.path.insert(0, os.path.join(ROOT, 'ourdb'))
+
+
+def temp_db_url(name):
+    """URL of a new SQLite database, for the tests that need their own storage"""
+    return 'sqlite:///' + os.path.join(_tmp, name + '.db')
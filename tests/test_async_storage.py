@@ -0,0 +1,77 @@
+import asyncio
+import importlib.util
+import unittest
+
+from tests import temp_db_url
+
+from storage import EntryType
+
+
+@unittest.skipUnless(importlib.util.find_spec('aiosqlite'), "aiosqlite is not installed")
+class AsyncDbStorageTest(unittest.TestCase):
+    def setUp(self):
+        from async_storage import AsyncDbStorage
+        self.loop = asyncio.new_event_loop()
+        self.storage = AsyncDbStorage(temp_db_url('async_' + self._testMethodName))
+        self.run_async(self.storage.init())
+
+    def tearDown(self):
+        self.run_async(self.storage.close())
+        self.loop.close()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_queries(self):
+        storage = self.storage
+
+        async def scenario():
+            async with storage.session_scope() as session:
+                self.assertEqual(await storage.import_pack(session, 1, 'cats', [('s', 'a'), ('s', 'b')]), 2)
+                self.assertTrue(await storage.add_entry(session, 1, 'kittens', EntryType.STICKER, 'c',
+                                                        only_remove=False))
+                self.assertFalse(await storage.add_entry(session, 1, 'cats', EntryType.STICKER, 'a'))
+            async with storage.session_scope() as session:
+                self.assertEqual(await storage.get_packs(session, 1), ['cats', 'kittens'])
+                self.assertEqual(await storage.get_entries(session, 1, 'cats', False), [('s', 'b')])
+                self.assertEqual(await storage.search_packs(session, 1, 'cat', 5), ['cats'])
+                self.assertEqual(await storage.count_total_entries(session, 1), 2)
+                self.assertEqual(await storage.get_existing_entries(session, 1, ['cats']), {'cats': {('s', 'b')}})
+                self.assertEqual([entry async for entry in storage.iter_all_entries(session, 1)],
+                                 [('cats', 's', 'b'), ('kittens', 's', 'c')])
+                self.assertTrue(await storage.remove_pack(session, 1, 'kittens'))
+            async with storage.session_scope() as session:
+                self.assertEqual(await storage.get_packs(session, 1), ['cats'])
+                self.assertEqual(await storage.reconcile_entry_counts(session), [])
+
+        self.run_async(scenario())
+
+    def test_failed_scope_is_rolled_back(self):
+        storage = self.storage
+
+        async def scenario():
+            with self.assertRaises(RuntimeError):
+                async with storage.session_scope() as session:
+                    await storage.import_pack(session, 1, 'cats', [('s', 'a')])
+                    raise RuntimeError
+            async with storage.session_scope() as session:
+                self.assertEqual(await storage.get_packs(session, 1), [])
+
+        self.run_async(scenario())
+
+    def test_changes_are_notified_after_commit(self):
+        storage = self.storage
+        changed = []
+        storage.add_change_listener(changed.append)
+
+        async def scenario():
+            async with storage.session_scope() as session:
+                await storage.import_pack(session, 1, 'cats', [('s', 'a')])
+                self.assertEqual(changed, [])
+
+        self.run_async(scenario())
+        self.assertEqual(changed, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+from unittest import mock
+
+import cache
+from cache import TtlLruCache
+
+
+class TtlLruCacheTest(unittest.TestCase):
+    def test_get_and_put(self):
+        c = TtlLruCache(10, 60)
+        self.assertIsNone(c.get('a'))
+        c.put('a', 1)
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.get('b', 'default'), 'default')
+        self.assertEqual((c.hits, c.misses), (1, 2))
+
+    def test_evicts_least_recently_used(self):
+        c = TtlLruCache(3, 60)
+        for key in 'abc':
+            c.put(key, key)
+        c.get('a')
+        c.put('d', 'd')
+        self.assertIsNone(c.get('b'))
+        self.assertEqual([c.get(key) for key in 'acd'], ['a', 'c', 'd'])
+        self.assertEqual(c.evictions, 1)
+
+    def test_sizeof(self):
+        c = TtlLruCache(10, 60, sizeof=len)
+        c.put('a', 'x' * 6)
+        c.put('b', 'x' * 6)
+        self.assertIsNone(c.get('a'))
+        self.assertEqual(c.size, 6)
+        # Never fits
+        c.put('c', 'x' * 11)
+        self.assertIsNone(c.get('c'))
+        self.assertEqual(c.get('b'), 'x' * 6)
+
+    def test_expires(self):
+        c = TtlLruCache(10, 60)
+        with mock.patch.object(cache.time, 'monotonic', return_value=1000):
+            c.put('a', 1)
+        with mock.patch.object(cache.time, 'monotonic', return_value=1059):
+            self.assertEqual(c.get('a'), 1)
+        with mock.patch.object(cache.time, 'monotonic', return_value=1061):
+            self.assertIsNone(c.get('a'))
+        self.assertEqual(len(c), 0)
+
+    def test_invalidate(self):
+        c = TtlLruCache(10, 60)
+        c.put('a', 1)
+        c.invalidate('a')
+        c.invalidate('missing')
+        self.assertIsNone(c.get('a'))
+        self.assertEqual(c.size, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
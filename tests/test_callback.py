@@ -0,0 +1,84 @@
+import unittest
+from unittest import mock
+
+from telegram import CallbackQuery, Update, User
+from telegram.ext import CommandHandler
+
+from callback import CallbackCommandHandler, CallbackRouter, route_callbacks
+
+
+def callback_update(data, update_id=1):
+    return Update(update_id, callback_query=CallbackQuery('1', User(1, 'user', False), 'chat', data=data))
+
+
+def dispatcher():
+    dispatcher = mock.Mock()
+    dispatcher.user_data = {1: {}}
+    return dispatcher
+
+
+class CallbackRouterTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.view = CallbackCommandHandler('v', lambda bot, update, data: self.calls.append(('v', data)) or 'viewed',
+                                           pass_data=True, auto_answer_query=False)
+        self.menu = CallbackCommandHandler('m', lambda bot, update: self.calls.append(('m',)),
+                                           auto_answer_query=False)
+        self.router = CallbackRouter([self.view, self.menu])
+
+    def test_routes_by_first_char(self):
+        self.assertTrue(self.router.check_update(callback_update('vcats')))
+        self.assertTrue(self.router.check_update(callback_update('m')))
+        self.assertEqual(self.router.handle_update(callback_update('vcats'), dispatcher()), 'viewed')
+        self.router.handle_update(callback_update('m'), dispatcher())
+        self.assertEqual(self.calls, [('v', 'cats'), ('m',)])
+
+    def test_ignores_other_updates(self):
+        self.assertFalse(self.router.check_update(callback_update('xcats')))
+        self.assertFalse(self.router.check_update(callback_update('')))
+        self.assertFalse(self.router.check_update(Update(1)))
+        self.assertFalse(self.router.check_update('not an update'))
+
+    def test_data_comes_from_the_update(self):
+        # Two updates checked before being handled (ex. by two threads) keep their own data
+        first, second = callback_update('vcats'), callback_update('vdogs', 2)
+        self.assertTrue(self.router.check_update(first))
+        self.assertTrue(self.router.check_update(second))
+        self.router.handle_update(first, dispatcher())
+        self.router.handle_update(second, dispatcher())
+        self.assertEqual(self.calls, [('v', 'cats'), ('v', 'dogs')])
+
+    def test_answers_the_query(self):
+        handler = CallbackCommandHandler('a', lambda bot, update: None)
+        update = callback_update('a')
+        with mock.patch.object(CallbackQuery, 'answer') as answer:
+            CallbackRouter([handler]).handle_update(update, dispatcher())
+        answer.assert_called_once_with()
+
+    def test_rejects_ambiguous_chars(self):
+        with self.assertRaises(ValueError):
+            CallbackRouter([self.view, CallbackCommandHandler('v', print)])
+        with self.assertRaises(ValueError):
+            CallbackRouter([CallbackCommandHandler('vv', print)])
+
+
+class RouteCallbacksTest(unittest.TestCase):
+    def test_replaces_the_callback_handlers(self):
+        start = CommandHandler('start', print)
+        view = CallbackCommandHandler('v', print)
+        stop = CommandHandler('stop', print)
+        menu = CallbackCommandHandler('m', print)
+        routed = route_callbacks([start, view, stop, menu])
+        self.assertEqual(len(routed), 3)
+        self.assertIs(routed[0], start)
+        self.assertIsInstance(routed[1], CallbackRouter)
+        self.assertEqual(routed[1].routes, {'v': view, 'm': menu})
+        self.assertIs(routed[2], stop)
+
+    def test_single_handler_is_kept(self):
+        view = CallbackCommandHandler('v', print)
+        self.assertEqual(route_callbacks((view,)), [view])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import signal
+import unittest
+from unittest import mock
+
+import cluster
+from cluster import WebhookCluster, update_user_id, worker_index
+
+
+def message(user_id, chat_id=None):
+    return {'update_id': 1, 'message': {'message_id': 1, 'from': {'id': user_id}, 'chat': {'id': chat_id or user_id}}}
+
+
+def echo_worker(index, connection, results, worker_init):
+    """Stands for run_worker, sends back every update it receives (create_updater is the results pipe)
+
+    Not a Queue, a killed worker could keep its lock like in the bug the cluster pipes fix
+    """
+    while True:
+        results.send((index, connection.recv()))
+
+
+class RoutingTest(unittest.TestCase):
+    def test_update_user_id(self):
+        self.assertEqual(update_user_id(message(5, chat_id=-100)), 5)
+        self.assertEqual(update_user_id({'callback_query': {'id': 'q', 'from': {'id': 6}}}), 6)
+        self.assertEqual(update_user_id({'inline_query': {'id': 'q', 'from': {'id': 7}, 'query': ''}}), 7)
+        self.assertEqual(update_user_id({'channel_post': {'message_id': 1, 'chat': {'id': -8}}}), -8)
+        self.assertIsNone(update_user_id({'update_id': 1}))
+
+    def test_worker_index(self):
+        self.assertEqual([worker_index(message(user_id), 4) for user_id in range(8)], [0, 1, 2, 3, 0, 1, 2, 3])
+        # Every update of a user goes to the same worker
+        self.assertEqual(worker_index({'callback_query': {'id': 'q', 'from': {'id': 6}}}, 4),
+                         worker_index(message(6, chat_id=-100), 4))
+        self.assertEqual(worker_index({'update_id': 1}, 4), 0)
+        self.assertIn(worker_index({'channel_post': {'message_id': 1, 'chat': {'id': -7}}}, 4), range(4))
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), "the cluster forks its workers")
+class WorkerTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(cluster, 'run_worker', echo_worker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.results, results_writer = cluster.multiprocessing.get_context('fork').Pipe(duplex=False)
+        self.cluster = WebhookCluster('token', 2, results_writer)
+        for index in range(2):
+            self.cluster._start_worker(index)
+        self.addCleanup(lambda: [process.terminate() for process in self.cluster.processes])
+
+    def received(self):
+        self.assertTrue(self.results.poll(5), "Nothing received")
+        return self.results.recv()
+
+    def test_route(self):
+        self.cluster.route(message(3))
+        self.cluster.route(message(4))
+        self.assertEqual(sorted(self.received()[0] for _ in range(2)), [0, 1])
+
+    def test_killed_worker_is_restarted(self):
+        self.cluster.route(message(3))
+        self.assertEqual(self.received(), (1, message(3)))
+        process = self.cluster.processes[1]
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+        # Queued while the worker is dead
+        self.cluster.route(message(5))
+
+        with self.assertLogs(level='ERROR'):
+            self.cluster.restart_dead_workers()
+        self.assertIsNot(self.cluster.processes[1], process)
+        self.assertEqual(self.received(), (1, message(5)))
+        self.cluster.route(message(7))
+        self.assertEqual(self.received(), (1, message(7)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+from database import storage
+from modules.export.export_pack import export_all_json, export_json
+from modules.export.import_parser import parse_import, open_import_file
+from storage import EntryType
+
+USER_ID = 5000
+PACKS = {
+    'cats': [(EntryType.STICKER.value, 'sticker%d' % i) for i in range(2500)] + [(EntryType.GIF.value, 'gif')],
+    'chats "quoted" \\ é': [(EntryType.STICKER.value, 'a\nb')],
+    'dogs': [(EntryType.PACK.value, 'set_a')],
+}
+
+
+def setUpModule():
+    with storage.session_scope() as session:
+        for name, entries in PACKS.items():
+            storage.import_pack(session, USER_ID, name, entries)
+
+
+def stored_packs():
+    with storage.session_scope() as session:
+        return [{'name': name, 'entries': [list(entry) for entry in storage.get_entries(session, USER_ID, name, False)]}
+                for name in sorted(PACKS)]
+
+
+class ExportTest(unittest.TestCase):
+    def test_export_all_round_trip(self):
+        data = export_all_json(USER_ID)
+        # Compressed, as sent by /exportall
+        self.assertEqual(data.read(2), b'\x1f\x8b')
+        data.seek(0)
+        packs = list(parse_import(open_import_file(data)))
+        self.assertEqual(sorted(packs, key=lambda pack: pack['name']), stored_packs())
+
+    def test_export_all_without_packs(self):
+        self.assertEqual(list(parse_import(open_import_file(export_all_json(USER_ID + 1)))), [])
+
+    def test_export_pack_round_trip(self):
+        with storage.session_scope() as session:
+            entries = storage.get_entries(session, USER_ID, 'dogs', False)
+        packs = list(parse_import(open_import_file(export_json([('dogs', entries)]))))
+        self.assertEqual(packs, [{'name': 'dogs', 'entries': [['p', 'set_a']]}])
+
+
+if __name__ == '__main__':
+    unittest.main()
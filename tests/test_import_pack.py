@@ -0,0 +1,66 @@
+import unittest
+
+from database import storage
+from metrics import query_budget
+from modules.export.import_pack import ImportEntry, ImportSession
+from storage import EntryType
+
+USER_ID = 6000
+OTHER_USER_ID = 6001
+STICKER = EntryType.STICKER.value
+
+
+def setUpModule():
+    with storage.session_scope() as session:
+        storage.import_pack(session, USER_ID, 'cats', [(STICKER, 'a'), (STICKER, 'b')])
+        storage.import_pack(session, USER_ID, 'dogs', [(EntryType.GIF.value, 'c')])
+        storage.import_pack(session, OTHER_USER_ID, 'birds', [(STICKER, 'd')])
+
+
+def raw_pack(name, *entries):
+    return {'name': name, 'entries': [[STICKER, entry] for entry in entries]}
+
+
+class GetExistingEntriesTest(unittest.TestCase):
+    def test_existing_entries(self):
+        with storage.session_scope() as session:
+            existing = storage.get_existing_entries(session, USER_ID, ['cats', 'dogs', 'birds', 'missing'])
+        # The missing packs and the packs of other users are left out
+        self.assertEqual(existing, {'cats': {(STICKER, 'a'), (STICKER, 'b')},
+                                    'dogs': {(EntryType.GIF.value, 'c')}})
+
+    def test_no_packs(self):
+        with storage.session_scope() as session:
+            self.assertEqual(storage.get_existing_entries(session, USER_ID, []), {})
+
+
+class ImportEntryTest(unittest.TestCase):
+    def test_new_pack(self):
+        entry = ImportEntry(USER_ID, raw_pack('new', 'a', 'b', 'a'))
+        entry.initialize(None)
+        self.assertFalse(entry.conflict)
+        self.assertEqual(entry.added_medias, 2)
+
+    def test_overlapping_pack(self):
+        entry = ImportEntry(USER_ID, raw_pack('cats', 'a', 'c', 'd'))
+        entry.initialize({(STICKER, 'a'), (STICKER, 'b')})
+        self.assertTrue(entry.conflict)
+        # Only the entries that aren't in the pack yet are counted
+        self.assertEqual(entry.added_medias, 2)
+
+
+class ImportSessionTest(unittest.TestCase):
+    def test_initialize_from_packs(self):
+        packs = [raw_pack('cats', 'a', 'b', 'c'), raw_pack('dogs', 'c'), raw_pack('birds', 'd')]
+        packs += [raw_pack('new%d' % i, 'x') for i in range(20)]
+        import_session = ImportSession(USER_ID)
+        # A single query, whatever the number of packs
+        with query_budget(1):
+            import_session.initialize_from_packs(packs)
+        self.assertEqual([(entry.name, entry.conflict, entry.added_medias) for entry in import_session.imports[:3]],
+                         [('cats', True, 1), ('dogs', True, 1), ('birds', False, 1)])
+        self.assertEqual(import_session.new_media_count, 23)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import gzip
+import io
+import json
+import unittest
+
+from modules.export.import_parser import ImportFileError, parse_import, open_import_file, MAX_VALUE_SIZE
+
+
+def parse(text, **kwargs):
+    return list(parse_import(io.StringIO(text), **kwargs))
+
+
+def export(packs, version='1.0'):
+    return json.dumps({'version': version, 'packs': [{'name': name, 'entries': entries} for name, entries in packs]})
+
+
+class ParseImportTest(unittest.TestCase):
+    def test_packs(self):
+        text = export([('cats', [['s', 'a'], ['g', 'b']]), ('empty', [])])
+        self.assertEqual(parse(text), [
+            {'name': 'cats', 'entries': [['s', 'a'], ['g', 'b']]},
+            {'name': 'empty', 'entries': []},
+        ])
+
+    def test_key_order_and_whitespace(self):
+        text = ' { "version" : "1.0" ,\n "packs" : [ { "entries" : [ [ "s" , "a" ] ] , "name" : "cats" } ] } '
+        self.assertEqual(parse(text), [{'name': 'cats', 'entries': [['s', 'a']]}])
+
+    def test_values_across_chunks(self):
+        # Every chunk boundary falls inside some value
+        entries = [['s', 'sticker%d' % i] for i in range(20000)]
+        self.assertEqual(parse(export([('big', entries)]))[0]['entries'], entries)
+
+    def test_gzip(self):
+        data = io.BytesIO(gzip.compress(export([('cats', [['s', 'a']])]).encode('utf-8')))
+        self.assertEqual(list(parse_import(open_import_file(data))), [{'name': 'cats', 'entries': [['s', 'a']]}])
+
+    def test_plain(self):
+        data = io.BytesIO(export([('cats', [['s', 'a']])]).encode('utf-8'))
+        self.assertEqual(len(list(parse_import(open_import_file(data)))), 1)
+
+    def assertRejected(self, text, message=None, **kwargs):
+        with self.assertRaises(ImportFileError) as cm:
+            parse(text, **kwargs)
+        if message is not None:
+            self.assertEqual(str(cm.exception), message)
+
+    def test_version(self):
+        self.assertRejected(export([], version='2.0'), "Version not supported")
+        self.assertRejected('{"packs": []}', "Version not supported")
+        self.assertRejected('{"packs": [], "version": "1.0"}', "Version not supported")
+
+    def test_invalid_entries(self):
+        self.assertRejected(export([('cats', [['x', 'a']])]), "Invalid entry in pack cats")
+        self.assertRejected(export([('cats', [['s', 1]])]))
+        self.assertRejected(export([('cats', [['s', 'a', 'b']])]))
+        self.assertRejected('{"version": "1.0", "packs": [{"name": "cats", "entries": 5}]}')
+
+    def test_invalid_packs(self):
+        self.assertRejected('{"version": "1.0", "packs": [{"name": "cats"}]}')
+        self.assertRejected('{"version": "1.0", "packs": [{"entries": []}]}')
+        self.assertRejected('{"version": "1.0", "packs": [5]}')
+        self.assertRejected(export([('a' * 51, [])]), "Pack name too long: " + 'a' * 50)
+
+    def test_malformed(self):
+        self.assertRejected('')
+        self.assertRejected('[]')
+        self.assertRejected('{"version": "1.0", "packs": [}')
+        self.assertRejected(export([('cats', [])])[:-1])
+        self.assertRejected(export([('cats', [])]) + ']')
+
+    def test_max_size(self):
+        text = export([('cats', [['s', 'sticker%d' % i] for i in range(10000)])])
+        self.assertRejected(text, "File too big, max size: 100 KB", max_size=100 * 1024)
+        self.assertEqual(len(parse(text, max_size=len(text))), 1)
+
+    def test_huge_value(self):
+        self.assertRejected('{"version": "1.0", "other": "%s", "packs": []}' % ('a' * (MAX_VALUE_SIZE * 20)))
+
+    def test_stops_at_first_bad_pack(self):
+        text = export([('cats', [['s', 'a']]), ('dogs', [['x', 'b']]), ('birds', [])])
+        packs = parse_import(io.StringIO(text))
+        self.assertEqual(next(packs)['name'], 'cats')
+        with self.assertRaises(ImportFileError):
+            next(packs)
+
+
+if __name__ == '__main__':
+    unittest.main()
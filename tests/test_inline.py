@@ -0,0 +1,35 @@
+import unittest
+from unittest import mock
+
+from database import storage
+from modules.main import inline
+from storage import EntryType
+
+USER_ID = 4000
+
+
+def setUpModule():
+    with storage.session_scope() as session:
+        for i in range(8):
+            storage.import_pack(session, USER_ID, 'cats%d' % i, [(EntryType.STICKER.value, 'cats%d_sticker' % i)])
+
+
+class InlineQueryTest(unittest.TestCase):
+    def setUp(self):
+        inline.inline_result_cache.clear()
+
+    def test_packs_are_capped(self):
+        with mock.patch.object(inline, 'INLINE_MAX_PACKS', 3):
+            entries = inline.get_query_entries(None, USER_ID, 'cats')
+        self.assertEqual(entries, [(EntryType.STICKER, 'cats%d_sticker' % i) for i in range(3)])
+
+    def test_results_are_cached(self):
+        entries = inline.get_query_entries(None, USER_ID, 'cats1')
+        self.assertEqual(entries, [(EntryType.STICKER, 'cats1_sticker')])
+        with mock.patch.object(storage, 'search_packs') as search_packs:
+            self.assertEqual(inline.get_query_entries(None, USER_ID, 'cats1'), entries)
+        search_packs.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
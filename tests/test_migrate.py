@@ -0,0 +1,77 @@
+import unittest
+
+from sqlalchemy import inspect
+
+from tests import temp_db_url
+
+from migrate import MIGRATED_LEGACY_TABLE, legacy_pack_entries, migrate
+from storage import DbStorage, EntryType, LEGACY_TABLE, OutdatedSchemaError
+
+
+class MigrateTest(unittest.TestCase):
+    def setUp(self):
+        self.storage = DbStorage(temp_db_url('migrate_' + self._testMethodName))
+        legacy_pack_entries.create(self.storage.engine)
+        self.write_legacy([(1, 'cats', 's', 'a'), (1, 'cats', 's', 'b'), (1, 'dogs', 'p', 'set'), (2, 'cats', 's', 'c')])
+
+    def write_legacy(self, rows):
+        with self.storage.engine.begin() as connection:
+            connection.execute(legacy_pack_entries.insert(), [
+                {'owner_id': owner_id, 'pack_name': name, 'entry_type': entry_type, 'entry_data': data}
+                for owner_id, name, entry_type, data in rows
+            ])
+
+    def delete_legacy(self, owner_id, name):
+        c = legacy_pack_entries.c
+        with self.storage.engine.begin() as connection:
+            connection.execute(legacy_pack_entries.delete().where(c.owner_id == owner_id, c.pack_name == name))
+
+    def packs(self, user_id):
+        with self.storage.session_scope() as session:
+            return {name: self.storage.get_entries(session, user_id, name, False)
+                    for name in self.storage.get_packs(session, user_id)}
+
+    def test_outdated_database_is_not_served(self):
+        with self.assertRaises(OutdatedSchemaError):
+            self.storage.init()
+
+    def test_copy_then_catch_up(self):
+        migrate(self.storage)
+        self.assertEqual(self.packs(1), {'cats': [('s', 'a'), ('s', 'b')], 'dogs': [('p', 'set')]})
+        # The old bot is still serving
+        with self.assertRaises(OutdatedSchemaError):
+            self.storage.init()
+        self.delete_legacy(1, 'dogs')
+        self.delete_legacy(2, 'cats')
+        self.write_legacy([(1, 'cats', 's', 'd')])
+
+        migrate(self.storage, redo=1)
+        self.assertEqual(self.packs(1), {'cats': [('s', 'a'), ('s', 'b'), ('s', 'd')]})
+        self.assertEqual(self.packs(2), {})
+        self.assertFalse(inspect(self.storage.engine).has_table(LEGACY_TABLE))
+        self.assertTrue(inspect(self.storage.engine).has_table(MIGRATED_LEGACY_TABLE))
+        self.storage.init()
+        with self.storage.session_scope() as session:
+            self.assertEqual(self.storage.count_total_entries(session, 1), 3)
+
+    def test_redo_keeps_the_new_writes(self):
+        migrate(self.storage)
+        migrate(self.storage, redo=1)
+        self.storage.init()
+        with self.storage.session_scope() as session:
+            self.storage.add_entry(session, 3, 'birds', EntryType.STICKER, 'e', only_remove=False)
+
+        migrate(self.storage, redo=1)
+        self.assertEqual(self.packs(3), {'birds': [('s', 'e')]})
+        self.assertEqual(self.packs(1), {'cats': [('s', 'a'), ('s', 'b')], 'dogs': [('p', 'set')]})
+
+    def test_drop_legacy(self):
+        migrate(self.storage, drop_legacy=True)
+        self.assertFalse(inspect(self.storage.engine).has_table(LEGACY_TABLE))
+        self.assertFalse(inspect(self.storage.engine).has_table(MIGRATED_LEGACY_TABLE))
+        self.storage.init()
+        self.assertEqual(self.packs(2), {'cats': [('s', 'c')]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import threading
+import unittest
+from concurrent.futures import CancelledError
+
+from telegram.error import RetryAfter
+
+from outbound import OutboundScheduler, PRIORITY_BULK, PRIORITY_INTERACTIVE
+
+
+class OutboundSchedulerTest(unittest.TestCase):
+    def test_submit_does_not_wait(self):
+        scheduler = OutboundScheduler(global_rate=100, chat_rate=100, chat_burst=100)
+        release = threading.Event()
+        future = scheduler.submit(PRIORITY_BULK, 1, True, release.wait, (5,))
+        self.assertFalse(future.done())
+        release.set()
+        self.assertTrue(future.result(5))
+
+    def test_chat_runs_in_order(self):
+        scheduler = OutboundScheduler(global_rate=100, chat_rate=100, chat_burst=100)
+        calls = []
+        futures = [scheduler.submit(PRIORITY_BULK, 1, True, calls.append, (i,)) for i in range(5)]
+        for future in futures:
+            future.result(5)
+        self.assertEqual(calls, list(range(5)))
+
+    def test_priority(self):
+        # Both calls wait for the global bucket, the most urgent one gets the next token
+        scheduler = OutboundScheduler(global_rate=10, chat_rate=100, chat_burst=100)
+        calls = []
+        with scheduler.condition:
+            scheduler.global_bucket.tokens = 0
+        bulk = scheduler.submit(PRIORITY_BULK, 2, True, calls.append, ('bulk',))
+        interactive = scheduler.submit(PRIORITY_INTERACTIVE, 3, True, calls.append, ('interactive',))
+        bulk.result(5)
+        interactive.result(5)
+        self.assertEqual(calls, ['interactive', 'bulk'])
+
+    def test_max_wait(self):
+        # The chat bucket allows a single call every 100 seconds
+        scheduler = OutboundScheduler(global_rate=100, chat_rate=0.01, chat_burst=1)
+        scheduler.submit(PRIORITY_BULK, 1, True, lambda: None).result(5)
+        with self.assertRaises(RetryAfter) as cm:
+            scheduler.call(PRIORITY_BULK, 1, True, lambda: None, max_wait=0.1)
+        self.assertGreater(cm.exception.retry_after, 90)
+
+    def test_retry_after_past_max_wait(self):
+        scheduler = OutboundScheduler(global_rate=100, chat_rate=100, chat_burst=100)
+
+        def flood():
+            raise RetryAfter(60)
+        with self.assertRaises(RetryAfter):
+            scheduler.call(PRIORITY_BULK, 1, True, flood, max_wait=1)
+        # The chat isn't blocked by the failed call
+        self.assertEqual(scheduler.call(PRIORITY_BULK, 1, True, lambda: 'ok'), 'ok')
+
+    def test_cancelled_calls_are_skipped(self):
+        scheduler = OutboundScheduler(global_rate=100, chat_rate=100, chat_burst=100)
+        calls = []
+        release = threading.Event()
+        scheduler.submit(PRIORITY_BULK, 1, True, release.wait, (5,))
+        skipped = scheduler.submit(PRIORITY_BULK, 1, True, calls.append, ('skipped',))
+        sent = scheduler.submit(PRIORITY_BULK, 1, True, calls.append, ('sent',))
+        self.assertTrue(skipped.cancel())
+        release.set()
+        sent.result(5)
+        with self.assertRaises(CancelledError):
+            skipped.result()
+        self.assertEqual(calls, ['sent'])
+
+
+if __name__ == '__main__':
+    unittest.main()
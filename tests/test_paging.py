@@ -0,0 +1,84 @@
+import unittest
+from types import SimpleNamespace
+
+from database import storage
+from modules.main import common
+from storage import EntryType
+
+USER_ID = 3000
+SET_SIZES = {'set_a': 3, 'set_b': 40, 'set_c': 1, 'set_d': 26, 'set_e': 7}
+PACKS = {
+    'alpha': ['set_a', 'set_b'] + ['alpha%02d' % i for i in range(12)],
+    'beta': ['beta%02d' % i for i in range(5)],
+    'gamma': ['set_c', 'set_d', 'set_e'],
+    'delta': ['set_e'] + ['delta%02d' % i for i in range(30)],
+}
+
+
+class FakeBot:
+    def __init__(self):
+        self.fetched = []
+
+    def get_sticker_set(self, name):
+        self.fetched.append(name)
+        return SimpleNamespace(name=name, stickers=[SimpleNamespace(file_id='%s_%d' % (name, i))
+                                                    for i in range(SET_SIZES[name])])
+
+
+def setUpModule():
+    with storage.session_scope() as session:
+        for name, entries in PACKS.items():
+            storage.import_pack(session, USER_ID, name, [
+                (EntryType.PACK.value if entry in SET_SIZES else EntryType.STICKER.value, entry) for entry in entries
+            ])
+
+
+class PagingTest(unittest.TestCase):
+    pack_names = ['alpha', 'beta', 'gamma', 'delta']
+
+    def setUp(self):
+        common.sticker_set_cache.clear()
+        common.sticker_set_sizes.clear()
+
+    def pages(self, bot, page_size):
+        entries = []
+        while True:
+            page, more = common.get_pack_entries(bot, USER_ID, self.pack_names, len(entries), page_size)
+            self.assertLessEqual(len(page), page_size)
+            entries += page
+            if not more:
+                return entries
+            self.assertEqual(len(page), page_size)
+
+    def test_full_expansion(self):
+        entries, more = common.get_pack_entries(FakeBot(), USER_ID, self.pack_names, 0)
+        self.assertFalse(more)
+        self.assertEqual(len(entries), sum(SET_SIZES.values()) + SET_SIZES['set_e'] + 12 + 5 + 30)
+        self.assertEqual(entries[:4], [(EntryType.STICKER, 'set_a_0'), (EntryType.STICKER, 'set_a_1'),
+                                       (EntryType.STICKER, 'set_a_2'), (EntryType.STICKER, 'set_b_0')])
+
+    def test_pages_match_the_full_expansion(self):
+        full, _ = common.get_pack_entries(FakeBot(), USER_ID, self.pack_names, 0)
+        for page_size in (1, 7, 25, 50):
+            with self.subTest(page_size=page_size):
+                # Cold: the set sizes are unknown
+                common.sticker_set_cache.clear()
+                common.sticker_set_sizes.clear()
+                self.assertEqual(self.pages(FakeBot(), page_size), full)
+                # Only the sizes are known, the sets before the window are skipped
+                common.sticker_set_cache.clear()
+                self.assertEqual(self.pages(FakeBot(), page_size), full)
+
+    def test_window_skips_known_sets(self):
+        common.get_pack_entries(FakeBot(), USER_ID, self.pack_names, 0)
+        common.sticker_set_cache.clear()
+        bot = FakeBot()
+        # The window starts after set_a and set_b, inside the plain entries of alpha, and ends inside set_d
+        page, more = common.get_pack_entries(bot, USER_ID, self.pack_names, 45, 20)
+        self.assertTrue(more)
+        self.assertEqual(page[:3], [(EntryType.STICKER, 'alpha%02d' % i) for i in (2, 3, 4)])
+        self.assertEqual(bot.fetched, ['set_c', 'set_d'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import itertools
+import unittest
+from types import SimpleNamespace
+
+from tests import temp_db_url
+
+import metrics
+from metrics import query_budget
+from persistence import DbPersistence, dump_user_data
+from storage import DbStorage
+
+storage = DbStorage(temp_db_url('persistence'))
+storage.init()
+metrics.instrument_engine(storage.engine)
+
+
+user_ids = itertools.count(1)
+
+
+def start():
+    """What a new bot process does: nothing is loaded yet"""
+    dispatcher = SimpleNamespace(user_data=None, process_update=lambda update: None)
+    handlers = {'main': SimpleNamespace(conversations={}), 'import': SimpleNamespace(conversations={})}
+    persistence = DbPersistence(storage)
+    persistence.attach(dispatcher, handlers)
+    return persistence, dispatcher.user_data, handlers
+
+
+class DbPersistenceTest(unittest.TestCase):
+    def setUp(self):
+        self.user_id = next(user_ids)
+        self.key = (self.user_id, self.user_id)
+        with storage.session_scope() as session:
+            storage.save_user_data(session, {self.user_id: dump_user_data({'pack': 'cats'})})
+            storage.save_conversation_states(session, 'main', {'[%d, %d]' % self.key: 2})
+
+    def test_user_data_loaded_on_first_access(self):
+        persistence, user_data, _ = start()
+        self.assertEqual(len(user_data), 0)
+        with query_budget(1):
+            self.assertEqual(user_data[self.user_id], {'pack': 'cats'})
+            self.assertEqual(user_data[self.user_id], {'pack': 'cats'})
+        # A user without saved data starts empty
+        self.assertEqual(user_data[next(user_ids)], {})
+
+    def test_conversations_loaded_on_first_access(self):
+        persistence, _, handlers = start()
+        main, imports = handlers['main'].conversations, handlers['import'].conversations
+        self.assertEqual(len(main), 0)
+        # One query loads the key in every ConversationHandler
+        with query_budget(1):
+            self.assertEqual(main.get(self.key), 2)
+            self.assertNotIn(self.key, imports)
+            self.assertIn(self.key, main)
+
+    def test_flush_writes_the_changes(self):
+        persistence, user_data, handlers = start()
+        user_data[self.user_id]['pack'] = 'dogs'
+        persistence.update_user_data(self.user_id)
+        handlers['main'].conversations.get(self.key)
+        del handlers['main'].conversations[self.key]
+        handlers['import'].conversations[self.key] = 1
+        persistence.flush()
+
+        _, user_data, handlers = start()
+        self.assertEqual(user_data[self.user_id], {'pack': 'dogs'})
+        self.assertIsNone(handlers['main'].conversations.get(self.key))
+        self.assertEqual(handlers['import'].conversations.get(self.key), 1)
+
+    def test_flush_keeps_the_states_not_loaded(self):
+        persistence, _, handlers = start()
+        other_key = (next(user_ids),) * 2
+        handlers['main'].conversations[other_key] = 1
+        persistence.flush()
+
+        _, _, handlers = start()
+        self.assertEqual(handlers['main'].conversations.get(self.key), 2)
+        self.assertEqual(handlers['main'].conversations.get(other_key), 1)
+
+    def test_flush_skips_unchanged_user_data(self):
+        persistence, user_data, _ = start()
+        user_data[self.user_id]
+        persistence.update_user_data(self.user_id)
+        with query_budget(0):
+            persistence.flush()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,223 @@
+import itertools
+import unittest
+
+from sqlalchemy import event
+
+from tests import temp_db_url
+
+import metrics
+from metrics import query_budget
+from storage import DbStorage, EntryType, UserStats
+
+storage = DbStorage(temp_db_url('storage'))
+storage.init()
+metrics.instrument_engine(storage.engine)
+
+
+user_ids = itertools.count(1)
+
+
+class StorageTestCase(unittest.TestCase):
+    """Gives every test its own user"""
+
+    def setUp(self):
+        self.user_id = next(user_ids)
+
+    def toggle(self, pack, data, only_remove=False):
+        with storage.session_scope() as session:
+            return storage.add_entry(session, self.user_id, pack, EntryType.STICKER, data, only_remove=only_remove)
+
+    def entries(self, pack):
+        with storage.session_scope() as session:
+            return storage.get_entries(session, self.user_id, pack, False)
+
+    def count(self):
+        with storage.session_scope() as session:
+            return storage.count_total_entries(session, self.user_id)
+
+
+class AddEntryTest(StorageTestCase):
+    def test_add_creates_the_pack(self):
+        self.assertTrue(self.toggle('cats', 'a'))
+        with storage.session_scope() as session:
+            self.assertEqual(storage.get_packs(session, self.user_id), ['cats'])
+        self.assertEqual(self.entries('cats'), [('s', 'a')])
+        self.assertEqual(self.count(), 1)
+
+    def test_toggle(self):
+        self.assertTrue(self.toggle('cats', 'a'))
+        self.assertTrue(self.toggle('cats', 'b'))
+        self.assertFalse(self.toggle('cats', 'a'))
+        self.assertEqual(self.entries('cats'), [('s', 'b')])
+        self.assertEqual(self.count(), 1)
+        self.assertTrue(self.toggle('cats', 'a'))
+        self.assertEqual(self.count(), 2)
+
+    def test_only_remove(self):
+        # Over the limits an entry can still be removed, but not added
+        self.toggle('cats', 'a')
+        self.assertTrue(self.toggle('cats', 'b', only_remove=True))
+        self.assertEqual(self.entries('cats'), [('s', 'a')])
+        self.assertFalse(self.toggle('cats', 'a', only_remove=True))
+        self.assertEqual(self.count(), 0)
+
+    def test_packs_are_separate(self):
+        self.toggle('cats', 'a')
+        self.assertTrue(self.toggle('dogs', 'a'))
+        self.assertFalse(self.toggle('cats', 'a'))
+        self.assertEqual(self.entries('dogs'), [('s', 'a')])
+
+    def test_users_are_separate(self):
+        self.toggle('cats', 'a')
+        self.user_id += 1000
+        self.assertTrue(self.toggle('cats', 'a'))
+        self.assertEqual(self.count(), 1)
+
+    def test_changed_users_are_notified(self):
+        changed = []
+        storage.add_change_listener(changed.append)
+        try:
+            self.toggle('cats', 'a')
+            self.toggle('cats', 'b', only_remove=True)
+        finally:
+            storage.change_listeners.remove(changed.append)
+        self.assertEqual(changed, [self.user_id])
+
+    def test_query_budget(self):
+        self.toggle('cats', 'a')
+        with query_budget(6):
+            self.toggle('cats', 'a')
+            self.toggle('cats', 'a')
+
+
+class ImportPackTest(StorageTestCase):
+    def test_batches(self):
+        # The entries are inserted in batches, not one statement per entry
+        entries = [(EntryType.STICKER.value, 'sticker%d' % i) for i in range(1000)]
+        with query_budget(12, max_repeats=5):
+            with storage.session_scope() as session:
+                self.assertEqual(storage.import_pack(session, self.user_id, 'cats', entries, batch_size=300), 1000)
+        self.assertEqual(self.count(), 1000)
+
+    def test_skips_duplicates(self):
+        self.toggle('cats', 'a')
+        entries = [(EntryType.STICKER.value, data) for data in ('a', 'b', 'b', 'c')]
+        with storage.session_scope() as session:
+            self.assertEqual(storage.import_pack(session, self.user_id, 'cats', entries), 2)
+        self.assertEqual(self.entries('cats'), [('s', 'a'), ('s', 'b'), ('s', 'c')])
+        self.assertEqual(self.count(), 3)
+
+
+class EntryCountTest(StorageTestCase):
+    def set_stored_count(self, count):
+        with storage.session_scope() as session:
+            session.query(UserStats).filter(UserStats.owner_id == self.user_id).delete()
+            if count is not None:
+                session.add(UserStats(owner_id=self.user_id, entry_count=count))
+
+    def reconcile(self):
+        with storage.session_scope() as session:
+            return storage.reconcile_entry_counts(session)
+
+    def test_kept_up_to_date(self):
+        with storage.session_scope() as session:
+            storage.import_pack(session, self.user_id, 'cats', [('s', 'a'), ('s', 'b'), ('p', 'set')])
+            storage.import_pack(session, self.user_id, 'dogs', [('s', 'a'), ('p', 'set')])
+        self.assertEqual(self.count(), 5)
+        with storage.session_scope() as session:
+            storage.remove_every_pack_mention(session, self.user_id, 'set')
+        self.assertEqual(self.count(), 3)
+        with storage.session_scope() as session:
+            self.assertTrue(storage.remove_pack(session, self.user_id, 'cats'))
+            self.assertFalse(storage.remove_pack(session, self.user_id, 'missing'))
+        self.assertEqual(self.count(), 1)
+        self.assertNotIn(self.user_id, self.reconcile())
+
+    def test_reconcile_repairs_drifted_counts(self):
+        self.toggle('cats', 'a')
+        self.toggle('cats', 'b')
+        self.set_stored_count(7)
+        self.assertIn(self.user_id, self.reconcile())
+        self.assertEqual(self.count(), 2)
+        self.assertNotIn(self.user_id, self.reconcile())
+
+    def test_reconcile_creates_missing_counts(self):
+        self.toggle('cats', 'a')
+        self.set_stored_count(None)
+        self.assertIn(self.user_id, self.reconcile())
+        self.assertEqual(self.count(), 1)
+
+    def test_reconcile_resets_users_without_entries(self):
+        self.set_stored_count(3)
+        self.assertIn(self.user_id, self.reconcile())
+        self.assertEqual(self.count(), 0)
+
+
+class UnitOfWorkTest(StorageTestCase):
+    def test_failed_scope_is_rolled_back(self):
+        with storage.unit_of_work():
+            with self.assertRaises(RuntimeError):
+                with storage.session_scope() as session:
+                    storage.import_pack(session, self.user_id, 'cats', [(EntryType.STICKER.value, 'a')])
+                    raise RuntimeError
+            with storage.session_scope() as session:
+                self.assertEqual(storage.get_packs(session, self.user_id), [])
+
+    def test_nested_scopes_share_the_transaction(self):
+        with storage.unit_of_work():
+            with storage.session_scope() as outer:
+                with storage.session_scope() as inner:
+                    self.assertIs(inner, outer)
+                    storage.import_pack(inner, self.user_id, 'cats', [(EntryType.STICKER.value, 'a')])
+                outer.rollback()
+        self.assertEqual(self.count(), 0)
+
+    def test_no_connection_held_between_scopes(self):
+        # SQLite files get a NullPool on SQLAlchemy 1.4, which can't tell its checked out connections
+        checked_out = [0]
+
+        def on_checkout(*args):
+            checked_out[0] += 1
+
+        def on_checkin(*args):
+            checked_out[0] -= 1
+        for name, listener in (('checkout', on_checkout), ('checkin', on_checkin)):
+            event.listen(storage.engine.pool, name, listener)
+            self.addCleanup(event.remove, storage.engine.pool, name, listener)
+
+        with storage.unit_of_work():
+            with storage.session_scope() as session:
+                storage.import_pack(session, self.user_id, 'cats', [(EntryType.STICKER.value, 'a')])
+            self.assertEqual(checked_out, [0])
+        self.assertEqual(self.entries('cats'), [('s', 'a')])
+
+
+class SearchPacksTest(StorageTestCase):
+    def search(self, query, limit=10):
+        with storage.session_scope() as session:
+            return storage.search_packs(session, self.user_id, query, limit)
+
+    def test_ranking(self):
+        for pack in ('wildcats', 'cats_and_dogs', 'cat', 'cats', 'dogs', 'catalog'):
+            self.toggle(pack, 'a')
+        # The exact match, then the prefixes (shortest first), then the other substrings
+        self.assertEqual(self.search('cat'), ['cat', 'cats', 'catalog', 'cats_and_dogs', 'wildcats'])
+        self.assertEqual(self.search('cat', limit=3), ['cat', 'cats', 'catalog'])
+        self.assertEqual(self.search('bird'), [])
+
+    def test_wildcards_are_escaped(self):
+        for pack in ('100%', '1000', 'a_b', 'axb', 'back\\slash', 'backslash'):
+            self.toggle(pack, 'a')
+        self.assertEqual(self.search('0%'), ['100%'])
+        self.assertEqual(self.search('%'), ['100%'])
+        self.assertEqual(self.search('a_'), ['a_b'])
+        self.assertEqual(self.search('k\\s'), ['back\\slash'])
+
+    def test_only_the_user_packs(self):
+        self.toggle('cats', 'a')
+        self.user_id = next(user_ids)
+        self.assertEqual(self.search('cats'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import itertools
+import unittest
+from collections import Counter
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+from database import storage
+from modules.main import view
+from storage import EntryType
+
+USER_ID = 4000
+
+
+class QueuedBot:
+    """Bot whose submitted calls stay queued until finish() is called, like a page waiting for the flood control"""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.queued = []
+        self.message_ids = itertools.count(1)
+
+    def submit(self, method_name, *args, **kwargs):
+        self.calls[method_name] += 1
+        future = Future()
+        self.queued.append((method_name, future))
+        return future
+
+    def finish(self):
+        queued, self.queued = self.queued, []
+        for method_name, future in queued:
+            future.set_result(SimpleNamespace(message_id=next(self.message_ids)) if method_name != 'delete_message'
+                              else True)
+
+
+def view_update(message_id=None):
+    user = SimpleNamespace(id=USER_ID)
+    callback_query = SimpleNamespace(message=SimpleNamespace(message_id=message_id)) if message_id else None
+    return SimpleNamespace(effective_user=user, effective_chat=user, callback_query=callback_query)
+
+
+def setUpModule():
+    with storage.session_scope() as session:
+        storage.import_pack(session, USER_ID, 'cats', [(EntryType.STICKER.value, 'sticker%02d' % i)
+                                                       for i in range(60)])
+
+
+class ViewPackTest(unittest.TestCase):
+    def setUp(self):
+        self.bot = QueuedBot()
+        self.user_data = {}
+
+    def view(self, arg, message_id=None):
+        view.view_pack(self.bot, view_update(message_id), arg, self.user_data)
+
+    def test_pages(self):
+        self.view('cats')
+        self.assertEqual(self.bot.calls['send_sticker'], 25)
+        self.bot.finish()
+        self.assertEqual(self.user_data['last_messages'], list(range(1, 26)))
+
+        self.view('cats|1', message_id=25)
+        self.bot.finish()
+        self.assertEqual(self.bot.calls, Counter(send_sticker=50, delete_message=25))
+        self.assertEqual(self.user_data['last_messages'], list(range(26, 51)))
+
+    def test_double_tap_while_the_page_is_queued(self):
+        self.view('cats')
+        self.bot.finish()
+        self.view('cats|1', message_id=25)
+        self.view('cats|1', message_id=25)
+        self.bot.finish()
+        self.assertEqual(self.bot.calls, Counter(send_sticker=50, delete_message=25))
+
+        # The new page navigates normally
+        last_message = self.user_data['last_messages'][-1]
+        self.view('cats|2', message_id=last_message)
+        self.assertEqual(self.bot.calls['send_sticker'], 60)
+        self.assertEqual(self.bot.calls['delete_message'], 50)
+
+    def test_old_page_is_ignored(self):
+        self.view('cats')
+        self.bot.finish()
+        self.view('cats|1', message_id=25)
+        self.bot.finish()
+        self.view('cats|0', message_id=3)
+        self.assertEqual(self.bot.calls['send_sticker'], 50)
+
+    def test_pages_sent_together_are_all_deleted(self):
+        self.view('cats')
+        self.view('cats')
+        self.bot.finish()
+        self.assertEqual(len(self.user_data['last_messages']), 50)
+        self.view('cats|1', message_id=self.user_data['last_messages'][-1])
+        self.assertEqual(self.bot.calls['delete_message'], 50)
+
+
+if __name__ == '__main__':
+    unittest.main()